@@ -1,16 +1,23 @@
+import time
 import boto3
+import hashlib
+import codec
 import jsonpickle
 import datetime
 import decimal
 from pynamodb.expressions.condition import Condition
 from pynamodb.models import Model
+from pynamodb.exceptions import GetError
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
 
 TABLE_NAME = "RallyBot"
 REGION = "us-east-2"
+# calls per BatchGetItem chunk before unprocessed (throttled) keys are given up on
+BATCH_GET_ATTEMPTS = 8
 
 boto3.setup_default_session(region_name=REGION)
 
+# items used to be stored with jsonpickle, the handlers are kept so those rows can still be read (see codec)
 # encode datetime objects as an ISO 8601 format string
 @jsonpickle.register(datetime.datetime)
 class DatePickleISO8601(jsonpickle.handlers.DatetimeHandler):
@@ -52,21 +59,33 @@ class RallyBotModel(Model):
 	sort = NumberAttribute(range_key=True)
 	data = UnicodeAttribute(null=True)
 
+def sort_key(text: str) -> int:
+	# 63 bits of the text's hash, so it fits a NumberAttribute sort key
+	return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'big') >> 1
+
 class DynamoDBClient:
 	def __init__(self):
 		self.pickler = jsonpickle.pickler.Pickler()
 		self.unpickler = jsonpickle.unpickler.Unpickler()
 		self._dynamodb = boto3.resource('dynamodb')
 		self._table = self._dynamodb.Table(TABLE_NAME)
+		# low-level client, returns items in the format Model.from_raw_data expects
+		self._client = boto3.client('dynamodb')
+		# read capacity consumed by the bulk reads below, callers diff it to get per-run usage
+		self.read_units = 0.0
+		# jsonpickle rows read so far, each one is rewritten with codec the next time it's saved if its class has a schema
+		self.legacy_reads = 0
 
+	# write_item and read_item aren't used by the bot at the moment, events and everything else are PynamoDB models
 	def write_item(self, item):
 		if isinstance(item, Model):
 			item.save()
 			return True
+		# classes without a schema are still stored the old way, so their rows can be written back
 		model_item = RallyBotModel(
 			id=item.id,
 			sort=item.sort,
-			data=jsonpickle.encode(item)
+			data=codec.encode(item) if codec.registered(type(item)) else jsonpickle.encode(item)
 		)
 		model_item.save()
 		return True
@@ -74,7 +93,10 @@ class DynamoDBClient:
 	def read_item(self, id, sort) -> RallyBotModel | None:
 		try:
 			item = RallyBotModel.get(id, sort)
-			return jsonpickle.decode(item.data)
+			if codec.is_legacy(item.data):
+				self.legacy_reads += 1
+				return jsonpickle.decode(item.data)
+			return codec.decode(item.data)
 		except RallyBotModel.DoesNotExist:
 			return None
 	
@@ -90,4 +112,59 @@ class DynamoDBClient:
 			return True
 		except Exception as e:
 			print(f"Error deleting item with id {id} and sort {sort}: {e}")
-			return False
\ No newline at end of file
+			return False
+
+	def scan_raw(self, index_name: str | None = None, attributes: list[str] | None = None) -> list[dict]:
+		"""
+		Reads a whole index (or the table) with as few round trips as DynamoDB allows.
+
+		Args:
+			index_name (str | None): The index to scan, or None for the base table.
+			attributes (list[str] | None): Only return these attributes.
+
+		Returns:
+			list[dict]: Items in the low-level attribute value format, see Model.from_raw_data.
+		"""
+		params = {'TableName': TABLE_NAME, 'ReturnConsumedCapacity': 'TOTAL'}
+		if index_name:
+			params['IndexName'] = index_name
+		if attributes:
+			names = {f"#a{i}": name for i, name in enumerate(attributes)}
+			params['ProjectionExpression'] = ", ".join(names.keys())
+			params['ExpressionAttributeNames'] = names
+		items = []
+		while True:
+			page = self._client.scan(**params)
+			self.read_units += page.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+			items.extend(page['Items'])
+			if 'LastEvaluatedKey' not in page:
+				return items
+			params['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+	def batch_get_raw(self, keys: list[tuple[str, int]]) -> list[dict]:
+		"""
+		Reads many items with BatchGetItem, 100 keys per call, retrying unprocessed keys.
+
+		Args:
+			keys (list[tuple[str, int]]): (id, sort) pairs.
+
+		Returns:
+			list[dict]: The items that exist, in the low-level attribute value format and in no particular order.
+		"""
+		items = []
+		for start in range(0, len(keys), 100):
+			request = {TABLE_NAME: {'Keys': [{'id': {'S': id}, 'sort': {'N': str(sort)}} for id, sort in keys[start:start + 100]]}}
+			attempt = 0
+			while request:
+				response = self._client.batch_get_item(RequestItems=request, ReturnConsumedCapacity='TOTAL')
+				for capacity in response.get('ConsumedCapacity', []):
+					self.read_units += capacity.get('CapacityUnits', 0)
+				items.extend(response['Responses'].get(TABLE_NAME, []))
+				request = response.get('UnprocessedKeys')
+				if request:
+					attempt += 1
+					if attempt >= BATCH_GET_ATTEMPTS:
+						raise GetError(f"{len(request[TABLE_NAME]['Keys'])} keys still unprocessed after {attempt} BatchGetItem calls")
+					# throttled, back off before asking for the rest
+					time.sleep(min(2.0, 0.05 * 2 ** attempt))
+		return items
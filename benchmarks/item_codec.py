@@ -0,0 +1,61 @@
+"""
+Compares codec against jsonpickle (with the handlers in aws) for the items
+DynamoDBClient.write_item stores: payload size and encode/decode throughput.
+
+Run from the repository root: python benchmarks/item_codec.py
+"""
+import os
+import sys
+import time
+import decimal
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jsonpickle
+import codec
+import aws  # registers the jsonpickle handlers old rows were written with
+
+class Item:
+	def __init__(self, n: int):
+		self.id = "benchmark"
+		self.sort = 313646790 + n
+		self.title = f"Board Games (Dice Dojo) (Edgewater) #{n}"
+		self.start = datetime.datetime(2025, 5, 1, 18, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))) + datetime.timedelta(days=n)
+		self.updated = datetime.datetime(2025, 4, 20, 12, 30, 15, tzinfo=datetime.timezone.utc)
+		self.going = n % 40
+		self.fee = decimal.Decimal("5.00")
+		self.online = False
+		self.tags = ["gaming", "board games"]
+
+codec.register(Item, 'bench', {
+	'id': str, 'sort': int, 'title': str, 'start': datetime.datetime, 'updated': datetime.datetime,
+	'going': int, 'fee': decimal.Decimal, 'online': bool, 'tags': list,
+})
+
+def throughput(fn, values: list) -> float:
+	start = time.perf_counter()
+	for value in values:
+		fn(value)
+	return len(values) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+	items = [Item(n) for n in range(5000)]
+	old_rows = [jsonpickle.encode(item) for item in items]
+	new_rows = [codec.encode(item) for item in items]
+	# what read_item hands back must survive the round trip
+	assert codec.decode(new_rows[1]).__dict__ == items[1].__dict__
+	assert codec.is_legacy(old_rows[1]) and not codec.is_legacy(new_rows[1])
+	old_size = sum(len(row.encode()) for row in old_rows) / len(items)
+	new_size = sum(len(row.encode()) for row in new_rows) / len(items)
+	print(f"jsonpickle row: {old_rows[1]}")
+	print(f"     codec row: {new_rows[1]}")
+	print(f"{'':>10} {'bytes/item':>10} {'encode/s':>10} {'decode/s':>10}")
+	results = {}
+	for name, encode, decode, rows, size in (
+		("jsonpickle", jsonpickle.encode, jsonpickle.decode, old_rows, old_size),
+		("codec", codec.encode, codec.decode, new_rows, new_size),
+	):
+		results[name] = (size, throughput(encode, items), throughput(decode, rows))
+		print(f"{name:>10} {size:10.0f} {results[name][1]:10.0f} {results[name][2]:10.0f}")
+	old, new = results['jsonpickle'], results['codec']
+	print(f"codec rows are {old[0] / new[0]:.1f}x smaller, encode {new[1] / old[1]:.1f}x and decode {new[2] / old[2]:.1f}x faster")
@@ -0,0 +1,73 @@
+"""
+Compares the targeted __NEXT_DATA__ extractor against the full BeautifulSoup parse on a
+realistic Meetup event page built around meetup_event_sample.json.
+
+Run from the repository root: python benchmarks/next_data.py
+"""
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import meetup
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'meetup_event_sample.json')
+
+def build_page(event: dict) -> str:
+	# real event pages carry a large apollo cache and group data next to the event, plus a lot of markup
+	apollo_state = {f"Event:{n}": dict(event, id=str(n)) for n in range(60)}
+	next_data = {
+		"props": {
+			"pageProps": {
+				"group": {"id": "36294429", "urlname": "chicago-anime-hangouts", "name": "Chicago Anime Hangouts"},
+				"event": event,
+				"__APOLLO_STATE__": apollo_state,
+			},
+			"__N_SSP": True,
+		},
+		"page": "/[urlname]/events/[eventId]",
+		"query": {"urlname": "chicago-anime-hangouts", "eventId": event['id']},
+		"buildId": "x" * 20,
+	}
+	head = "".join(f'<link rel="preload" href="/_next/static/chunks/{n}.js" as="script"/>' for n in range(80))
+	head += "".join(f'<meta property="og:tag{n}" content="{event["title"]}"/>' for n in range(40))
+	body = "".join(
+		f'<div class="flex items-center gap-2"><span class="text-sm">{n}</span><a href="{event["eventUrl"]}">{event["title"]}</a></div>'
+		for n in range(2000)
+	)
+	return (
+		f'<!DOCTYPE html><html lang="en"><head><title>{event["title"]}</title>{head}</head>'
+		f'<body><div id="__next">{body}</div>'
+		f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(next_data)}</script>'
+		f'<script src="/_next/static/chunks/main.js" defer=""></script></body></html>'
+	)
+
+def measure(name: str, fn, html: str, rounds: int):
+	start = time.perf_counter()
+	for _ in range(rounds):
+		fn(html)
+	per_page = (time.perf_counter() - start) / rounds
+	tracemalloc.start()
+	fn(html)
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(f"{name:>10}: {per_page * 1000:8.2f} ms/page {peak / 1024:10.0f} KiB peak")
+	return per_page, peak
+
+if __name__ == "__main__":
+	with open(SAMPLE) as f:
+		event = json.load(f)
+	html = build_page(event)
+	print(f"page size: {len(html) / 1024:.0f} KiB")
+	assert meetup.extract_event_fast(html) == event
+	fast_time, fast_peak = measure("fast", meetup.extract_event_fast, html, 200)
+	try:
+		import bs4, lxml
+	except ImportError:
+		print("beautifulsoup4/lxml not installed, skipping the full parse")
+		sys.exit(0)
+	assert meetup.extract_event_soup(html) == event
+	soup_time, soup_peak = measure("soup", meetup.extract_event_soup, html, 20)
+	print(f"speedup: {soup_time / fast_time:.0f}x cpu, {soup_peak / fast_peak:.0f}x less peak memory")
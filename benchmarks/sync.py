@@ -0,0 +1,377 @@
+"""
+End-to-end sync benchmark that runs entirely offline: a local HTTP server stands in for
+Meetup (RSS feed and __NEXT_DATA__ event pages built from meetup_event_sample.json), a fake
+guild stands in for Discord and storage.MemoryStore stands in for DynamoDB.
+
+For each event count the bot's own update_events, fetch_meetup_events and notify_events run
+against those stand-ins in a fresh process, and the wall time, time to the first discord
+event write and requests per backend of every phase are reported, along with the peak
+memory of the whole process:
+	cold     first sync, every event is new
+	notify   startup catch-up, adopts discord-only events and restores reminders
+	warm     second sync, nothing changed
+	fetch    fetch_meetup_events on its own
+	changed  sync after 10% of the events were edited and 5% were cancelled
+
+Discord rate limits are lifted so the numbers show our own overhead rather than the
+outbox waiting on its buckets.
+
+Run from the repository root: python benchmarks/sync.py [--events 10 100 1000] [--latency 20]
+	--json PATH       also write the results to PATH
+	--baseline PATH   compare wall times against results written earlier with --json
+"""
+import os
+import re
+import sys
+import json
+import time
+import types
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import datetime as dt
+from collections import Counter
+from xml.sax.saxutils import escape
+from urllib.parse import urlsplit, urlunsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, 'meetup_event_sample.json')
+GROUP_URL = "https://www.meetup.com/chicago-anime-hangouts/events/"
+# spread the generated events over the categories, the last one is deliberately ambiguous
+TOPICS = ["Board Games", "Karaoke Night", "Ramen Dinner", "Watch Party", "Picnic", "Book Club", "Hangout"]
+CHANNELS = ["book-club", "conventions", "food", "gaming", "karaoke", "outdoor", "watch-party", "volunteering", "events-general"]
+PHASES = ["cold", "notify", "warm", "fetch", "changed"]
+
+class FakeMeetup:
+	"""
+	The slice of meetup.com the bot reads, served over real HTTP with ETags so the HTTP
+	cache behaves the way it does in production.
+	"""
+	def __init__(self, sample: dict, count: int, latency: float):
+		self.latency = latency
+		self.requests = Counter()
+		self.events: dict[int, dict] = {}
+		# cancelled events drop out of the feed and their page returns 404
+		self.gone: set[int] = set()
+		self._lock = threading.Lock()
+		now = dt.datetime.now(dt.timezone.utc).replace(microsecond=0)
+		for n in range(count):
+			guid = 400000000 + n
+			topic = TOPICS[n % len(TOPICS)]
+			start = now + dt.timedelta(hours=6 * (n + 1))
+			self.events[guid] = dict(sample,
+				id=str(guid),
+				title=f"{topic} #{n}",
+				description=f"{topic.lower()} meetup for chicago anime hangouts! just show up :D\n\n"
+					+ "name tags will be brought to indicate who's a part of the meetup.\n" * 12,
+				eventUrl=f"{GROUP_URL}{guid}/",
+				eventType="ONLINE" if n % 7 == 6 else "PHYSICAL",
+				dateTime=start.isoformat(),
+				endTime=(start + dt.timedelta(hours=2)).isoformat(),
+			)
+
+	def rss(self) -> str:
+		items = "".join(
+			f"<item><title>{escape(event['title'])}</title><link>{event['eventUrl']}</link>"
+			f"<description>{escape(event['description'])}</description><guid>{event['eventUrl']}</guid></item>"
+			for guid, event in self.events.items() if guid not in self.gone
+		)
+		return f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Chicago Anime Hangouts</title>{items}</channel></rss>'
+
+	def page(self, guid: int) -> str | None:
+		event = self.events.get(guid)
+		if event is None or guid in self.gone:
+			return None
+		next_data = {
+			"props": {"pageProps": {"group": {"urlname": "chicago-anime-hangouts"}, "event": event}, "__N_SSP": True},
+			"page": "/[urlname]/events/[eventId]",
+			"query": {"urlname": "chicago-anime-hangouts", "eventId": event['id']},
+		}
+		body = "".join(f'<div class="flex"><a href="{event["eventUrl"]}">{escape(event["title"])}</a></div>' for _ in range(100))
+		return (
+			f'<!DOCTYPE html><html><head><title>{escape(event["title"])}</title></head><body><div id="__next">{body}</div>'
+			f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(next_data)}</script></body></html>'
+		)
+
+	def edit(self, guid: int, **fields):
+		with self._lock:
+			self.events[guid] = dict(self.events[guid], **fields)
+
+	def serve(self) -> ThreadingHTTPServer:
+		meetup = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				time.sleep(meetup.latency)
+				path = urlsplit(self.path).path
+				match = re.fullmatch(r"/chicago-anime-hangouts/events/(\d+)/", path)
+				with meetup._lock:
+					if path == "/chicago-anime-hangouts/events/rss":
+						kind, body = 'rss', meetup.rss()
+					elif match:
+						kind, body = 'detail', meetup.page(int(match.group(1)))
+					else:
+						kind, body = 'other', None
+				if body is None:
+					meetup.requests[f"{kind} 404"] += 1
+					self.send_response(404)
+					self.send_header('Content-Length', '0')
+					self.end_headers()
+					return
+				data = body.encode()
+				etag = f'"{hashlib.sha1(data).hexdigest()}"'
+				if self.headers.get('If-None-Match') == etag:
+					meetup.requests[f"{kind} 304"] += 1
+					self.send_response(304)
+					self.send_header('ETag', etag)
+					self.end_headers()
+					return
+				meetup.requests[f"{kind} 200"] += 1
+				self.send_response(200)
+				self.send_header('ETag', etag)
+				self.send_header('Content-Length', str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		server.daemon_threads = True
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		return server
+
+def local_adapter(address: str, pool_maxsize: int):
+	from requests.adapters import HTTPAdapter
+
+	class LocalAdapter(HTTPAdapter):
+		# sends requests for meetup.com to the fake server, the bot keeps using the real urls
+		def send(self, request, **kwargs):
+			parts = urlsplit(request.url)
+			request.url = urlunsplit(('http', address, parts.path, parts.query, ''))
+			return super().send(request, **kwargs)
+
+	return LocalAdapter(pool_maxsize=pool_maxsize)
+
+class FakeScheduledEvent:
+	def __init__(self, guild: 'FakeGuild', id: int, creator_id: int, name: str, description: str,
+			start_time: dt.datetime, end_time: dt.datetime | None, location: str, **kwargs):
+		import discord
+		self.guild = guild
+		self.guild_id = guild.id
+		self.id = id
+		self.creator_id = creator_id
+		self.name = name
+		self.description = description
+		self.start_time = start_time
+		self.end_time = end_time
+		self.location = location
+		self.status = discord.EventStatus.scheduled
+		self.entity_type = kwargs.get('entity_type', discord.EntityType.external)
+
+	async def edit(self, **fields):
+		await self.guild.call('edit_scheduled_event')
+		for name, value in fields.items():
+			setattr(self, name, value)
+		return self
+
+	async def delete(self):
+		await self.guild.call('delete_scheduled_event')
+		self.guild.scheduled_events.pop(self.id, None)
+
+class FakeChannel:
+	def __init__(self, guild: 'FakeGuild', id: int, name: str):
+		self.guild = guild
+		self.id = id
+		self.name = name
+		self.messages: list[str] = []
+
+	async def send(self, message: str):
+		await self.guild.call('send_message')
+		self.messages.append(message)
+
+class FakeGuild:
+	"""
+	The discord.Guild calls the bot makes, each one counted and delayed by `latency` seconds.
+	"""
+	id = 1219601473948614737
+	bot_id = 1
+	someone_else = 2
+
+	def __init__(self, latency: float):
+		self.latency = latency
+		self.requests = Counter()
+		self.scheduled_events: dict[int, FakeScheduledEvent] = {}
+		self.channels = [FakeChannel(self, 1000 + n, name) for n, name in enumerate(CHANNELS)]
+		self._ids = iter(range(900000000000000000, 1000000000000000000))
+		# time.perf_counter() of the first event creation or edit, reset by every phase
+		self.first_write: float | None = None
+
+	async def call(self, name: str):
+		self.requests[name] += 1
+		if name in ('create_scheduled_event', 'edit_scheduled_event') and self.first_write is None:
+			self.first_write = time.perf_counter()
+		await asyncio.sleep(self.latency)
+
+	def add_event(self, creator_id: int, **fields) -> FakeScheduledEvent:
+		event = FakeScheduledEvent(self, next(self._ids), creator_id, **fields)
+		self.scheduled_events[event.id] = event
+		return event
+
+	async def fetch_scheduled_events(self):
+		await self.call('fetch_scheduled_events')
+		return list(self.scheduled_events.values())
+
+	async def fetch_scheduled_event(self, id: int):
+		import discord
+		await self.call('fetch_scheduled_event')
+		if int(id) not in self.scheduled_events:
+			raise discord.errors.NotFound(types.SimpleNamespace(status=404, reason="Not Found"), "Unknown Guild Scheduled Event")
+		return self.scheduled_events[int(id)]
+
+	def get_scheduled_event(self, id: int):
+		return self.scheduled_events.get(int(id))
+
+	async def create_scheduled_event(self, **fields):
+		await self.call('create_scheduled_event')
+		return self.add_event(self.bot_id, **fields)
+
+	async def fetch_channels(self):
+		await self.call('fetch_channels')
+		return self.channels
+
+def peak_rss_kib() -> int:
+	try:
+		import resource
+	except ImportError:
+		return 0
+	# kilobytes on linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+async def run_child(count: int, latency: float) -> dict:
+	sys.path.insert(0, ROOT)
+	from shared import shared
+	import outbox
+	import main
+	await main.load_modules()
+	events = main.events
+	for route, (_, per) in outbox.ROUTE_LIMITS.items():
+		outbox.ROUTE_LIMITS[route] = (10 ** 9, per)
+	shared.loop_lag.start(shared.loop)
+
+	with open(SAMPLE) as f:
+		meetup = FakeMeetup(json.load(f), count, latency)
+	server = meetup.serve()
+	shared.http.session.mount("https://www.meetup.com", local_adapter(f"127.0.0.1:{server.server_port}", shared.http.per_host_limit))
+	guild = FakeGuild(latency)
+	shared.guild = guild
+	# events made by someone else while the bot was offline, adopted by notify_events
+	now = dt.datetime.now(dt.timezone.utc)
+	for n in range(max(1, count // 20)):
+		guild.add_event(FakeGuild.someone_else, name=f"Drop-in Karaoke #{n}", description="karaoke, just show up",
+			start_time=now + dt.timedelta(days=n + 1), end_time=None, location="Somewhere, Chicago")
+
+	results = {'events': count, 'rss_before_kib': peak_rss_kib(), 'phases': {}}
+
+	async def phase(name: str, fn):
+		meetup_before, discord_before, storage_before = Counter(meetup.requests), Counter(guild.requests), Counter(shared.store.requests)
+		shared.loop_lag.take_max()
+		guild.first_write = None
+		start = time.perf_counter()
+		await fn()
+		# deletions of discord events are handed to the loop without being awaited
+		for _ in range(10):
+			await asyncio.sleep(0)
+		results['phases'][name] = {
+			'wall': time.perf_counter() - start,
+			'first_write': guild.first_write - start if guild.first_write else None,
+			'meetup': dict(meetup.requests - meetup_before),
+			'discord': dict(guild.requests - discord_before),
+			'storage': dict(shared.store.requests - storage_before),
+			'loop_lag': shared.loop_lag.take_max(),
+		}
+
+	async def fetch():
+		await shared.run_blocking(events.fetch_meetup_events)
+
+	async def change():
+		guids = list(meetup.events)
+		for guid in guids[::10]:
+			meetup.edit(guid, title=f"{meetup.events[guid]['title']} (moved)")
+		meetup.gone.update(guids[3::20])
+		await main.update_events()
+
+	await phase('cold', main.update_events)
+	await phase('notify', main.notify_events)
+	await phase('warm', main.update_events)
+	await phase('fetch', fetch)
+	await phase('changed', change)
+	results['peak_rss_kib'] = peak_rss_kib()
+	server.shutdown()
+	return results
+
+def counts(requests: dict) -> str:
+	total = sum(requests.values())
+	if not total:
+		return "0"
+	return f"{total} ({', '.join(f'{name}: {n}' for name, n in sorted(requests.items()))})"
+
+def report(results: list[dict], baseline: dict[int, dict] | None):
+	for result in results:
+		print(f"\n{result['events']} events, peak RSS {result['peak_rss_kib'] / 1024:.1f} MiB "
+			f"({(result['peak_rss_kib'] - result['rss_before_kib']) / 1024:.1f} MiB above startup)")
+		for name in PHASES:
+			stats = result['phases'][name]
+			wall = f"{stats['wall']:8.3f}s"
+			base = (baseline or {}).get(result['events'], {}).get('phases', {}).get(name)
+			if base:
+				wall += f" ({stats['wall'] / base['wall']:5.2f}x baseline)"
+			first = f"{stats['first_write']:7.3f}s" if stats.get('first_write') is not None else "       -"
+			print(f"  {name:>8}: {wall}  first write {first}  lag {stats['loop_lag'] * 1000:4.0f}ms")
+			for backend in ('meetup', 'discord', 'storage'):
+				print(f"  {'':>8}  {backend:>8}: {counts(stats[backend])}")
+
+def main():
+	parser = argparse.ArgumentParser(description="offline end-to-end sync benchmark")
+	parser.add_argument('--events', type=int, nargs='+', default=[10, 100, 1000])
+	parser.add_argument('--latency', type=float, default=20, help="milliseconds added to every fake Meetup and Discord call")
+	parser.add_argument('--json', help="write the results to this file")
+	parser.add_argument('--baseline', help="compare against results written with --json")
+	parser.add_argument('--verbose', action='store_true', help="show the bot's own output")
+	parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+	parser.add_argument('--out', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child is not None:
+		result = asyncio.run(run_child(args.child, args.latency / 1000))
+		with open(args.out, 'w') as f:
+			json.dump(result, f)
+		return
+
+	results = []
+	for count in args.events:
+		# every size runs in a fresh process, so module state and peak memory don't carry over
+		with tempfile.TemporaryDirectory() as cache_dir:
+			env = {name: value for name, value in os.environ.items() if name not in ('QUIET_RALLY', 'RALLY_DRY_RUN', 'DO_AI_ENDPOINT', 'DO_AI_SECRET')}
+			env.update(RALLY_STORAGE='memory', RALLY_CACHE_DIR=cache_dir)
+			out = os.path.join(cache_dir, 'result.json')
+			print(f"running {count} events...", flush=True)
+			subprocess.run([sys.executable, os.path.abspath(__file__), '--child', str(count), '--latency', str(args.latency), '--out', out],
+				env=env, check=True, stdout=None if args.verbose else subprocess.DEVNULL)
+			with open(out) as f:
+				results.append(json.load(f))
+	baseline = None
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = {result['events']: result for result in json.load(f)}
+	report(results, baseline)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent='\t')
+
+if __name__ == "__main__":
+	main()
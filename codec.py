@@ -0,0 +1,95 @@
+import json
+import datetime
+import decimal
+
+# payloads are JSON arrays, [tag, version, field values...], jsonpickle rows are JSON objects
+_separators = (',', ':')
+
+class Schema:
+	"""
+	The fields of a stored class in a fixed order. Rows written with an older version are
+	decoded with that version's fields and passed through its upgrade function.
+	"""
+	def __init__(self, cls: type, tag: str, fields: dict[str, type], version: int):
+		self.cls = cls
+		self.tag = tag
+		self.fields = list(fields.items())
+		self.version = version
+		# version -> (fields, function turning that version's values into the next version's)
+		self.previous: dict[int, tuple] = {}
+
+	def add_previous(self, version: int, fields: dict[str, type], upgrade):
+		self.previous[version] = (list(fields.items()), upgrade)
+
+_by_class: dict[type, Schema] = {}
+_by_tag: dict[str, Schema] = {}
+
+def register(cls: type, tag: str, fields: dict[str, type], version: int = 1) -> Schema:
+	"""
+	Stores a class with this codec in DynamoDBClient.write_item, classes without a schema are jsonpickled.
+
+	Args:
+		cls (type): The class, decoded instances are made without calling __init__.
+		tag (str): Short name stored in every row, must never change once rows exist.
+		fields (dict[str, type]): Attribute names and types in storage order. Supported types
+			are str, int, float, bool, datetime.datetime, decimal.Decimal, list and dict
+			(of plain JSON values), any field may be None.
+		version (int): Bump this whenever fields change and describe the old layout with
+			Schema.add_previous.
+	"""
+	schema = Schema(cls, tag, fields, version)
+	_by_class[cls] = schema
+	_by_tag[tag] = schema
+	return schema
+
+def registered(cls: type) -> bool:
+	return cls in _by_class
+
+def _encode_value(value, kind: type):
+	if value is None:
+		return None
+	if kind is datetime.datetime:
+		return value.isoformat()
+	if kind is decimal.Decimal:
+		return str(value)
+	return value
+
+def _decode_value(value, kind: type):
+	if value is None:
+		return None
+	if kind is datetime.datetime:
+		return datetime.datetime.fromisoformat(value)
+	if kind is decimal.Decimal:
+		return decimal.Decimal(value)
+	return value
+
+def encode(obj) -> str:
+	schema = _by_class.get(type(obj))
+	if schema is None:
+		raise ValueError(f"no schema registered for {type(obj).__name__}, see codec.register")
+	row = [schema.tag, schema.version]
+	row.extend(_encode_value(getattr(obj, name, None), kind) for name, kind in schema.fields)
+	return json.dumps(row, separators=_separators, ensure_ascii=False)
+
+def is_legacy(data: str) -> bool:
+	# rows written by jsonpickle before this codec existed
+	return not data.startswith('[')
+
+def decode(data: str):
+	tag, version, *values = json.loads(data)
+	schema = _by_tag.get(tag)
+	if schema is None:
+		raise ValueError(f"no schema registered for tag {tag!r}")
+	if version == schema.version:
+		fields = schema.fields
+	elif version in schema.previous:
+		fields = schema.previous[version][0]
+	else:
+		raise ValueError(f"unknown version {version} of {tag!r}")
+	state = {name: _decode_value(value, kind) for (name, kind), value in zip(fields, values)}
+	while version != schema.version:
+		state = schema.previous[version][1](state)
+		version += 1
+	obj = schema.cls.__new__(schema.cls)
+	obj.__dict__.update(state)
+	return obj
@@ -0,0 +1,232 @@
+from shared import CACHE_DIR
+from aws import RallyBotModel, sort_key
+
+import os
+import time
+import heapq
+import struct
+import threading
+from traceback import format_exc as get_stacktrace
+from pynamodb.attributes import NumberAttribute
+from pynamodb.exceptions import PutError, DeleteError
+
+# where the hashes of sent messages are kept so restarts don't repeat them, 'dynamodb' or 'file'
+DEDUP = os.getenv('RALLY_DEDUP') or ('file' if os.getenv('RALLY_STORAGE') == 'memory' else 'dynamodb')
+# a message isn't sent to the same channel again for this long, unless the caller says otherwise
+DEDUP_HOURS = float(os.getenv('RALLY_DEDUP_HOURS', '24'))
+# upper bound on remembered messages, the ones closest to expiring are forgotten first
+DEDUP_MAX = int(os.getenv('RALLY_DEDUP_MAX', '20000'))
+DEDUP_PATH = os.path.join(CACHE_DIR, 'sent_messages')
+
+def message_key(channel_id: int, message: str) -> int:
+	return sort_key(f"{channel_id}\n{message}")
+
+class FileBackend:
+	"""
+	Append-only file of (key, expires) records, 16 bytes each, the last record of a key wins.
+	Rewritten with only the live keys once it's mostly expired or replaced records.
+	"""
+	record = struct.Struct('<Qd')
+
+	def __init__(self, path: str = DEDUP_PATH):
+		self.path = path
+		self.records = 0
+		self._lock = threading.Lock()
+
+	def load(self, now: float) -> dict[int, float]:
+		try:
+			with open(self.path, 'rb') as f:
+				data = f.read()
+		except OSError:
+			return {}
+		# a write cut short by a crash leaves a partial record at the end
+		data = data[:len(data) - len(data) % self.record.size]
+		self.records = len(data) // self.record.size
+		latest = dict(self.record.iter_unpack(data))
+		return {key: expires for key, expires in latest.items() if expires > now}
+
+	def write(self, key: int, expires: float) -> bool:
+		with self._lock:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path, 'ab') as f:
+				f.write(self.record.pack(key, expires))
+			self.records += 1
+		return True
+
+	def release(self, key: int, expires: float):
+		# an expired record replaces the claim
+		self.write(key, 0.0)
+
+	def remove(self, evicted: list[tuple[int, float]]):
+		# dropped by the next compaction
+		pass
+
+	def compact(self, live: dict[int, float]):
+		if self.records < 2 * len(live) + 1024:
+			return
+		with self._lock:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			temp = f"{self.path}.tmp"
+			with open(temp, 'wb') as f:
+				f.write(b"".join(self.record.pack(key, expires) for key, expires in live.items()))
+			os.replace(temp, self.path)
+			self.records = len(live)
+
+class SentMessage(RallyBotModel):
+	"""
+	id 'sent' rows, sort is the message_key of a sent message. expires is in epoch seconds,
+	so it can also be the table's TTL attribute.
+	"""
+	expires = NumberAttribute(null=True)
+
+class DynamoDBBackend:
+	"""
+	SentMessage rows in the RallyBot table. Writes are conditional, so when several replicas
+	share the table only the first one to claim a message sends it.
+	"""
+	def load(self, now: float) -> dict[int, float]:
+		live, expired = {}, []
+		for row in SentMessage.query('sent'):
+			if row.expires and row.expires > now:
+				live[int(row.sort)] = float(row.expires)
+			else:
+				expired.append((int(row.sort), row.expires))
+		if expired:
+			self.remove(expired)
+			print(f"Removed {len(expired)} expired sent message records")
+		return live
+
+	def write(self, key: int, expires: float) -> bool:
+		try:
+			SentMessage(id='sent', sort=key, expires=expires).save(condition=SentMessage.sort.does_not_exist() | (SentMessage.expires < time.time()))
+			return True
+		except PutError as e:
+			if e.cause_response_code == 'ConditionalCheckFailedException':
+				return False
+			raise
+
+	def _delete(self, key: int, expires: float | None):
+		try:
+			# unless another replica has claimed it again since
+			condition = SentMessage.expires.does_not_exist() if expires is None else SentMessage.expires == expires
+			SentMessage(id='sent', sort=key).delete(condition=condition)
+		except DeleteError as e:
+			if e.cause_response_code != 'ConditionalCheckFailedException':
+				raise
+
+	def release(self, key: int, expires: float):
+		self._delete(key, expires)
+
+	def remove(self, evicted: list[tuple[int, float]]):
+		# rows are deleted as they're evicted, load removes those left behind by a stopped replica
+		for key, expires in evicted:
+			self._delete(key, expires)
+
+	def compact(self, live: dict[int, float]):
+		pass
+
+class DedupIndex:
+	"""
+	Hashes of recently sent messages, each with its own expiry. Lookups are a dict hit,
+	the oldest keys are evicted through a heap, and every claim is written through to
+	the backend so a restart (or another replica) sees it.
+	"""
+	def __init__(self, backend, max_keys: int = DEDUP_MAX):
+		self.backend = backend
+		self.max_keys = max_keys
+		self._expires: dict[int, float] = None
+		# (expires, key), entries of keys claimed again since are skipped when popped
+		self._heap: list[tuple[float, int]] = []
+		# (key, expires) forgotten here but not yet removed from the backend
+		self._evicted: list[tuple[int, float]] = []
+		self._lock = threading.Lock()
+		self.claimed = 0
+		self.duplicates = 0
+
+	def _load(self):
+		now = time.time()
+		self._expires = self.backend.load(now)
+		self._heap = [(expires, key) for key, expires in self._expires.items()]
+		heapq.heapify(self._heap)
+		self._evict(now)
+		self.backend.compact(self._expires)
+		print(f"Loaded {len(self._expires)} sent message hashes")
+
+	def _evict(self, now: float):
+		while self._heap and (self._heap[0][0] <= now or len(self._expires) > self.max_keys):
+			expires, key = heapq.heappop(self._heap)
+			if self._expires.get(key) == expires:
+				del self._expires[key]
+				self._evicted.append((key, expires))
+
+	def _remove_evicted(self):
+		with self._lock:
+			evicted, self._evicted = self._evicted, []
+		if not evicted:
+			return
+		try:
+			self.backend.remove(evicted)
+		except Exception:
+			print(f"WARNING: couldn't remove {len(evicted)} sent message records\n{get_stacktrace()}")
+
+	def claim(self, key: int, seconds: float | None = None) -> bool:
+		"""
+		Records a message as sent unless it already was within its time to live. Blocking,
+		the first call loads the index from the backend.
+
+		Args:
+			key (int): See message_key.
+			seconds (float | None): How long the message is held back for, DEDUP_HOURS by default.
+
+		Returns:
+			bool: Whether the caller should send it.
+		"""
+		now = time.time()
+		expires = now + (DEDUP_HOURS * 3600 if seconds is None else seconds)
+		with self._lock:
+			if self._expires is None:
+				self._load()
+			self._evict(now)
+			if self._expires.get(key, 0) > now:
+				self.duplicates += 1
+				return False
+			self._expires[key] = expires
+			heapq.heappush(self._heap, (expires, key))
+			self._evict(now)
+			self.backend.compact(self._expires)
+		self._remove_evicted()
+		try:
+			written = self.backend.write(key, expires)
+		except Exception:
+			# it's still remembered here, and a missed announcement is worse than a repeated one
+			print(f"WARNING: couldn't record a sent message, it may be repeated after a restart\n{get_stacktrace()}")
+			written = True
+		if not written:
+			# another replica sent it first
+			self.duplicates += 1
+			return False
+		self.claimed += 1
+		return True
+
+	def release(self, key: int):
+		"""
+		Forgets a claimed message that couldn't be sent after all, so it's sent again next
+		time instead of being held back for its whole time to live. Blocking.
+		"""
+		with self._lock:
+			expires = (self._expires or {}).pop(key, None)
+			if expires is None:
+				return
+			self.claimed -= 1
+		try:
+			self.backend.release(key, expires)
+		except Exception:
+			print(f"WARNING: couldn't release a message that failed to send, it's held back until it expires\n{get_stacktrace()}")
+
+	def stats(self) -> str:
+		return f"{len(self._expires or ())} remembered, {self.claimed} sent, {self.duplicates} duplicates held back"
+
+def create_index() -> DedupIndex:
+	if DEDUP == 'file':
+		return DedupIndex(FileBackend())
+	return DedupIndex(DynamoDBBackend())
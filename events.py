@@ -1,24 +1,51 @@
-from aws import RallyBotModel
+from aws import RallyBotModel, sort_key
 from shared import shared
+import groups
+import meetup
+import metrics
+import net
 
 import discord
-import requests
+import asyncio
 import xml.etree.ElementTree as ET
-from bs4 import BeautifulSoup, Tag
 import datetime as dt
 from apscheduler.util import astimezone
 import re
 import os
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 from decimal import Decimal
 from traceback import format_exc as get_stacktrace
-from pynamodb.exceptions import AttributeDeserializationError, DeleteError
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute, UTCDateTimeAttribute, BooleanAttribute
+from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
 
-guid_finder = re.compile("https://www.meetup.com/chicago-anime-hangouts/events/([0-9]+)/")
+guid_finder = re.compile("https://www.meetup.com/[^/]+/events/([0-9]+)/")
+
+# an event page is fetched again after this long even if its RSS item hasn't changed
+DETAIL_MAX_AGE_HOURS = float(os.getenv('RALLY_DETAIL_MAX_AGE_HOURS', '24'))
+# the fields of props.pageProps.event that update_event_from_json reads
+PAGE_FIELDS = ['title', 'description', 'eventUrl', 'eventType', 'dateTime', 'endTime', 'venue', 'status']
 
 categories = ["book club", "conventions", "food", "gaming", "karaoke", "outdoor", "watch party", "volunteering", "other"]
 
+class UpcomingIndex(GlobalSecondaryIndex):
+	# (id, timestamp) lets us query only the events that haven't happened yet
+	class Meta:
+		index_name = "id-timestamp-index"
+		projection = AllProjection()
+
+	id = UnicodeAttribute(hash_key=True)
+	timestamp = NumberAttribute(range_key=True)
+
+class SnowflakeIndex(GlobalSecondaryIndex):
+	class Meta:
+		index_name = "snowflake_id-index"
+		projection = AllProjection()
+
+	snowflake_id = NumberAttribute(hash_key=True)
+
 class MeetupEvent(RallyBotModel):
 	title = UnicodeAttribute(null=True)
 	description = UnicodeAttribute(null=True)
@@ -30,6 +57,14 @@ class MeetupEvent(RallyBotModel):
 	snowflake_id = NumberAttribute(default=0)
 	category = UnicodeAttribute(null=True)
 	online = BooleanAttribute(default=False)
+	# the groups.Group the event belongs to, None for events stored before there were several groups
+	meetup_group = UnicodeAttribute(null=True)
+	# hashes of the RSS item and of the event page fields we use, and when the page was last fetched (ms)
+	rss_fingerprint = UnicodeAttribute(null=True)
+	page_fingerprint = UnicodeAttribute(null=True)
+	page_checked = NumberAttribute(null=True)
+	upcoming_index = UpcomingIndex()
+	snowflake_index = SnowflakeIndex()
 
 	# timestamp properties for backward compatibility
 	@property
@@ -69,6 +104,58 @@ class MeetupEvent(RallyBotModel):
 	def __init__(self, **kwargs) -> None:
 		super().__init__(**kwargs)
 		self.id = "event"
+		# serialized attribute values as of the last read from or write to dynamodb, None for new events
+		self._stored: dict | None = None
+
+	@classmethod
+	def from_raw_data(cls, data):
+		event = super().from_raw_data(data)
+		event._mark_stored()
+		return event
+
+	def deserialize(self, attribute_values):
+		# called with the stored item after update() and refresh()
+		super().deserialize(attribute_values)
+		self._mark_stored()
+
+	def _mark_stored(self):
+		self._stored = self.serialize(null_check=False)
+
+	def changed_attributes(self) -> list[str]:
+		# names of the attributes that differ from what's stored in dynamodb
+		current = self.serialize(null_check=False)
+		stored = self._stored or {}
+		return [name for name, attr in self.get_attributes().items() if current.get(attr.attr_name) != stored.get(attr.attr_name)]
+
+	def save(self, condition = None, *, add_version_condition = True, guard = False):
+		"""
+		Writes only what changed since the event was loaded: nothing if no attribute changed,
+		an UpdateItem of the changed attributes for stored events, or a full PutItem for new ones.
+
+		Args:
+			condition: An optional extra condition for the write.
+			guard (bool): Only update if the changed attributes still hold the values we loaded,
+				so changes made by a concurrent writer aren't overwritten.
+		"""
+		if self._stored is None:
+			res = super().save(condition, add_version_condition=add_version_condition)
+			self._mark_stored()
+			return res
+		actions = []
+		# never recreate a row that was deleted since it was loaded
+		condition &= MeetupEvent.sort.exists()
+		for name in self.changed_attributes():
+			attr = self.get_attributes()[name]
+			if attr.is_hash_key or attr.is_range_key:
+				continue
+			value = getattr(self, name)
+			actions.append(attr.remove() if value is None else attr.set(value))
+			if guard:
+				stored = self._stored.get(attr.attr_name)
+				condition &= attr.does_not_exist() if stored is None else attr == attr.deserialize(attr.get_value(stored))
+		if not actions:
+			return None
+		return self.update(actions, condition, add_version_condition=add_version_condition)
 	
 	def __str__(self) -> str:
 		date_str = self.start_time.strftime("%Y-%m-%d %I:%M %p") if hasattr(self, 'datetime') and self.start_time else "No date set"
@@ -79,7 +166,7 @@ class MeetupEvent(RallyBotModel):
 	@staticmethod
 	def from_discord_event(event: discord.ScheduledEvent):
 		print(f"snowflake {event.id} ({event.name}) not found in ddb, creating...")
-		ddb_event = MeetupEvent(event.id)
+		ddb_event = MeetupEvent(sort=event.id)
 		ddb_event.title = event.name
 		ddb_event.description = event.description
 		ddb_event.category = ai_categorize(f"{event.name}\n\n{event.description}")
@@ -87,60 +174,116 @@ class MeetupEvent(RallyBotModel):
 		ddb_event.location = event.location
 		ddb_event.snowflake_id = event.id
 		ddb_event.online = (event.entity_type != discord.EntityType.external)
-		ddb_event.save()
+		ddb_event.meetup_group = groups.current().meetup_group
+		shared.store.update(ddb_event)
 		return ddb_event
 
-	def delete(self, condition = None, *, add_version_condition = True):
-		res = None
-		try:
-			discord_id = int(self.snowflake_id) if self.snowflake_id else None
-			res = super().delete(condition, add_version_condition=add_version_condition)
-			if discord_id:
-				devent = shared.guild.get_scheduled_event(discord_id)
-				devent.delete()
-			return res
-		except DeleteError:
-			print(f"ERROR: Failed to delete event {self.sort} | {self.title} from dynamodb!")
-		except Exception as e:
-			print(f"ERROR: Exception while deleting event {self.sort} | {self.title}\n{get_stacktrace()}")
-		return None
+	def delete_discord_event(self):
+		if self.snowflake_id:
+			# this usually runs on the I/O executor, so hand the discord call back to the event loop
+			# and the guild is picked here, in the group's context
+			asyncio.run_coroutine_threadsafe(_delete_scheduled_event(shared.guild, int(self.snowflake_id)), shared.loop)
+
+async def _delete_scheduled_event(guild: discord.Guild, snowflake_id: int):
+	try:
+		devent = guild.get_scheduled_event(snowflake_id) or await guild.fetch_scheduled_event(snowflake_id)
+		await devent.delete()
+	except discord.errors.NotFound:
+		pass
+	except Exception:
+		print(f"ERROR: Exception while deleting discord event {snowflake_id}\n{get_stacktrace()}")
+
+# everything notify_events needs to know about an event, see load_snowflake_index
+SNOWFLAKE_INDEX_ATTRIBUTES = ['id', 'sort', 'snowflake_id', 'title', 'timestamp', 'category', 'online', 'meetup_group']
 
-def xml_to_dict(xml_string):
+def load_snowflake_index() -> dict[int, MeetupEvent]:
 	"""
-	Converts an XML string to a dictionary, placing all <item> tags into an 'item' array.
+	Loads every event that has a discord event with a single projected scan of
+	snowflake_id-index, keyed by snowflake id. The events only carry
+	SNOWFLAKE_INDEX_ATTRIBUTES, so they must not be saved back.
+	"""
+	return shared.store.snowflake_index(SNOWFLAKE_INDEX_ATTRIBUTES)
+
+def find_by_snowflake(snowflake_id: int) -> MeetupEvent | None:
+	return shared.store.by_snowflake(snowflake_id)
+
+# characters of the feed handed to the XML parser at a time
+RSS_CHUNK = 65536
+
+def _element_to_dict(element) -> dict:
+	node = {}
+	for child in element:
+		node[child.tag] = _element_to_dict(child) if len(child) else child.text
+	return node
+
+def iter_rss_items(xml_string: str):
+	"""
+	Parses an RSS feed incrementally, yielding every <item> as a dict of its child tags as
+	soon as it's complete. Items are dropped from the tree once yielded, so the parsed
+	document never holds more than one of them.
 
 	Args:
-		xml_string (str): The XML string to be converted.
+		xml_string (str): The RSS feed.
 
-	Returns:
-		dict: A dictionary representation of the XML.
+	Yields:
+		dict: The item's child tags and their text.
 	"""
-	def element_to_dict(element):
-		# Convert an XML element and its children to a dictionary
-		node = {}
-		for child in element:
-			if child.tag == "item":
-				if "item" not in node:
-					node["item"] = []
-				node["item"].append(element_to_dict(child))
-			else:
-				node[child.tag] = element_to_dict(child) if list(child) else child.text
-		return node
+	parser = ET.XMLPullParser(events=('start', 'end'))
+	parents = []
+	for start in range(0, len(xml_string), RSS_CHUNK) or [0]:
+		with metrics.span('parse'):
+			parser.feed(xml_string[start:start + RSS_CHUNK])
+			if start + RSS_CHUNK >= len(xml_string):
+				parser.close()
+			ready = list(parser.read_events())
+		for kind, element in ready:
+			if kind == 'start':
+				parents.append(element)
+				continue
+			parents.pop()
+			if element.tag == 'item':
+				yield _element_to_dict(element)
+				if parents:
+					parents[-1].remove(element)
+
+# parsed page bodies by url, reused for as long as the body hash stays the same. Unchanged feed items
+# skip their page entirely (see needs_detail), so this only has to cover one sync's worth of pages
+PARSED_PAGES_MAX = 256
+_parsed_pages: OrderedDict[str, tuple[str, object]] = OrderedDict()
+_parsed_pages_lock = threading.Lock()
 
-	root = ET.fromstring(xml_string)
-	return {root.tag: element_to_dict(root)}
+def _parse_once(response, parse):
+	if response.body_hash is None:
+		with metrics.span('parse'):
+			return parse(response.text)
+	with _parsed_pages_lock:
+		memo = _parsed_pages.get(response.url)
+		if memo and memo[0] == response.body_hash:
+			_parsed_pages.move_to_end(response.url)
+			return memo[1]
+	with metrics.span('parse'):
+		value = parse(response.text)
+	with _parsed_pages_lock:
+		_parsed_pages[response.url] = (response.body_hash, value)
+		_parsed_pages.move_to_end(response.url)
+		while len(_parsed_pages) > PARSED_PAGES_MAX:
+			_parsed_pages.popitem(last=False)
+	return value
 
 def _meetup_url_to_json(url: str) -> dict | int:
-	response = requests.get(url)
+	with metrics.span('detail_fetch'):
+		response = shared.http.get_cached(url)
 	if response.status_code != 200:
 		return response.status_code
-	soup = BeautifulSoup(response.text, features="lxml")
-	j_item: dict = json.loads(soup.select_one('script#__NEXT_DATA__').text)
-	return j_item['props']['pageProps']['event']
+	match = guid_finder.match(url)
+	return _parse_once(response, lambda html: meetup.extract_event(html, match.group(1) if match else None))
 
-def update_event_from_json(event: MeetupEvent, j_item: dict):
-	if not event.category:
-		event.category = ai_categorize(f"{j_item['title'].strip()}\n\n{j_item['description'].strip()}")
+def _categorize_text(j_item: dict) -> str:
+	return f"{j_item['title'].strip()}\n\n{j_item['description'].strip()}"
+
+def update_event_from_json(event: MeetupEvent, j_item: dict, categorize: bool = True):
+	if not event.category and categorize:
+		event.category = ai_categorize(_categorize_text(j_item))
 	event.link = j_item['eventUrl']
 	event.title = j_item['title'].strip()
 	event.description = j_item['description'].strip()
@@ -158,77 +301,388 @@ def update_event_from_json(event: MeetupEvent, j_item: dict):
 	else:
 		event.location = "Online"
 
-def fetch_meetup_events() -> list[MeetupEvent]:
+def _fingerprint(value) -> str:
+	return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+def rss_fingerprint(rss_item: dict) -> str:
+	return _fingerprint(rss_item)
+
+def _page_fingerprint(j_item: dict) -> str:
+	return _fingerprint({field: j_item.get(field) for field in PAGE_FIELDS})
+
+def _max_age_ms(guid: int) -> int:
+	# spread over an extra quarter of the max age, so events first seen together aren't all refetched in the same run
+	return int(DETAIL_MAX_AGE_HOURS * 3600 * 1000 * (1 + (guid % 16) / 64))
+
+def needs_detail(event: MeetupEvent | None, guid: int | None, fingerprint: str, now: int) -> bool:
+	if guid is None or event is None or not event.category:
+		return True
+	return event.rss_fingerprint != fingerprint or now - (event.page_checked or 0) > _max_age_ms(guid)
+
+def rss_guid(rss_item: dict) -> int | None:
+	match = guid_finder.match(rss_item.get('guid') or "")
+	return int(match.group(1)) if match else None
+
+def now_ms() -> int:
+	return int(dt.datetime.now(shared.est).timestamp() * 1000)
+
+def fetch_rss() -> net.CachedResponse:
+	with metrics.span('rss_fetch'):
+		response = shared.http.get_cached(groups.current().rss_url)
+	response.raise_for_status()  # Raise an exception for HTTP errors
+	return response
+
+def fetch_event(rss_item: dict, guid: int | None, fingerprint: str, stored: dict[int, MeetupEvent | None], now: int,
+		save: bool = True) -> tuple[MeetupEvent, str | None] | None:
 	"""
-	Fetches the RSS feed from the Meetup URL and converts it to a list of objects.
+	Fetches an RSS item's event page and brings its event up to date with it in memory.
+	Raises net.CircuitOpenError when Meetup is being skipped.
+
+	Args:
+		stored (dict[int, MeetupEvent | None]): The stored events by guid, see EventStore.batch_get.
+		now (int): When the page was checked, in ms.
+		save (bool): With False an unreadable stored row is left for the caller to delete,
+			see reconcile.DeleteUnreadable.
+
+	Returns:
+		tuple[MeetupEvent, str | None] | None: The event and, if it has no category yet, the text
+		to categorize it by. None for a new event that isn't active.
 	"""
-	ret = []
-	url = "https://www.meetup.com/chicago-anime-hangouts/events/rss"
-	response = requests.get(url)
-	response.raise_for_status()  # Raise an exception for HTTP errors
-	rss_content = xml_to_dict(response.text)
-	for rss_item in rss_content['rss']['channel']['item']:
-		try:
-			guid = int(guid_finder.match(rss_item['guid']).group(1))
-			j_item = _meetup_url_to_json(rss_item['link'])
+	if guid is None:
+		raise ValueError(f"couldn't find an event id in {rss_item['guid']}")
+	j_item = _meetup_url_to_json(rss_item['link'])
+	if isinstance(j_item, int):
+		raise ValueError(f"{rss_item['link']} returned {j_item}")
 
-			try:
-				event = MeetupEvent.get('event', guid)
-			except MeetupEvent.DoesNotExist:
-				if j_item['status'] != "ACTIVE":
-					# don't do anything with a non-active event
-					continue
-				event = MeetupEvent(sort=guid)
-			except AttributeDeserializationError:
-				# this can happen if the data in ddb is corrupted or in an unexpected format
-				print(f"data for event with guid {guid} is attempting to mitigate...")
-				raw_item = shared.ddb.read_raw('event', guid)
-				event = MeetupEvent(sort=guid)
-				if not raw_item:
-					print(f"no raw data found for event with guid {guid}, deleting and recreating...")
-				else:
-					if raw_item['snowflake_id']:
-						event.snowflake_id = int(raw_item['snowflake_id'])
-					if raw_item['category']:
-						event.category = raw_item['category']
+	if guid not in stored:
+		if j_item['status'] != "ACTIVE":
+			# don't do anything with a non-active event
+			return None
+		event = MeetupEvent(sort=guid)
+	else:
+		event = stored[guid]
+		if event is None:
+			# this can happen if the data in ddb is corrupted or in an unexpected format
+			print(f"data for event with guid {guid} is attempting to mitigate...")
+			raw_item = shared.ddb.read_raw('event', guid)
+			event = MeetupEvent(sort=guid)
+			if not raw_item:
+				print(f"no raw data found for event with guid {guid}, deleting and recreating...")
+			else:
+				if raw_item['snowflake_id']:
+					event.snowflake_id = int(raw_item['snowflake_id'])
+				if raw_item['category']:
+					event.category = raw_item['category']
+				if save:
 					shared.ddb.delete_raw('event', guid)
-			
-			update_event_from_json(event, j_item)
-			
-			event.save()
-			ret.append(event)
-		except Exception as e:
+
+	page_fingerprint = _page_fingerprint(j_item)
+	if event.page_fingerprint != page_fingerprint:
+		# categorized by the caller, so many events can go out in one batch
+		update_event_from_json(event, j_item, categorize=False)
+		event.page_fingerprint = page_fingerprint
+	event.rss_fingerprint = fingerprint
+	event.page_checked = now
+	event.meetup_group = groups.current().meetup_group
+	return event, None if event.category else _categorize_text(j_item)
+
+def categorize_events(uncategorized: list[tuple[MeetupEvent, str]], save: bool = True):
+	# sets the category of each event from its text, events the categorizers couldn't place are left without one
+	if not uncategorized:
+		return
+	try:
+		with metrics.span('categorize'):
+			answers = categorize_many([text for _, text in uncategorized], save)
+		for (event, _), category in zip(uncategorized, answers):
+			event.category = category
+	except Exception:
+		print(f"Exception occured while categorizing events:\n{get_stacktrace()}")
+
+def fetch_meetup_events(deferred: set[int] | None = None, unreadable: set[int] | None = None) -> list[MeetupEvent]:
+	"""
+	Fetches the RSS feed from the Meetup URL and converts it to a list of objects. Nothing at
+	all is written (not even the category cache), the events are only updated in memory and
+	the caller writes them. Used by dry runs, syncs go through pipeline.sync instead, which
+	doesn't wait for the whole feed.
+
+	Args:
+		deferred (set[int] | None): Gets the guids of events that were skipped because
+			Meetup's circuit is open, they're picked up again on the next run.
+		unreadable (set[int] | None): Gets the guids of events whose stored row couldn't be
+			read and has to be deleted before the rebuilt event is written.
+	"""
+	ret = []
+	uncategorized: list[tuple[MeetupEvent, str]] = []
+	group = groups.current()
+	rss_items = list(iter_rss_items(fetch_rss().text))
+	guids = [rss_guid(rss_item) for rss_item in rss_items]
+	fingerprints = [rss_fingerprint(rss_item) for rss_item in rss_items]
+	# load every stored event in the feed with as few BatchGetItem calls as possible
+	stored = shared.store.batch_get([guid for guid in guids if guid is not None])
+	now = now_ms()
+	# only fetch the detail pages of new events and of RSS items that changed (or haven't been checked in a while)
+	to_fetch = [i for i, (guid, fingerprint) in enumerate(zip(guids, fingerprints)) if needs_detail(stored.get(guid), guid, fingerprint, now)]
+	print(f"Fetching {len(to_fetch)} of {len(rss_items)} event pages, the rest are unchanged since their last fetch")
+	# over the shared connection pool
+	fetched = dict(zip(to_fetch, shared.http.map(lambda i: fetch_event(rss_items[i], guids[i], fingerprints[i], stored, now, save=False), to_fetch)))
+	for i, (rss_item, guid) in enumerate(zip(rss_items, guids)):
+		if i not in fetched:
+			ret.append(stored[guid])
+			continue
+		result = fetched[i]
+		if isinstance(result, net.CircuitOpenError) and guid is not None:
+			if deferred is not None:
+				deferred.add(guid)
+			continue
+		try:
+			if isinstance(result, Exception):
+				raise result
+		except Exception:
 			print(f"Exception occured while processing {rss_item}:\n{get_stacktrace()}")
+			continue
+		if result:
+			event, text = result
+			if text:
+				uncategorized.append((event, text))
+			if unreadable is not None and guid in stored and stored[guid] is None:
+				unreadable.add(guid)
+			ret.append(event)
+	if deferred:
+		print(f"Deferred {len(deferred)} events to the next run, {group.rss_url} is failing")
+	categorize_events(uncategorized, save=False)
 	return ret
 
-def check_existing_event(event: MeetupEvent):
-	url = f"https://www.meetup.com/chicago-anime-hangouts/events/{event.sort}/"
-	j_item = _meetup_url_to_json(url)
+def _event_url(guid) -> str:
+	return groups.current().event_url(guid)
+
+def _recheck_result(event: MeetupEvent, j_item: dict | int) -> tuple[bool | None, str | None]:
+	# True: event is still active and has been updated, False: event should be deleted, None: leave it alone.
+	# along with the text to categorize it by if it has no category yet, see categorize_events
 	if j_item == 404:
 		if int(event.sort) != int(event.snowflake_id):
-			print(f"{url} returned 404, deleting event with guid {event.sort} from ddb...")
-			event.delete()
-		return False
+			print(f"{_event_url(event.sort)} returned 404, deleting event with guid {event.sort} from ddb...")
+			return False, None
+		return None, None
+	if isinstance(j_item, int):
+		print(f"{_event_url(event.sort)} returned {j_item}, leaving event {event.sort} | {event.title} alone")
+		return None, None
 	if j_item['status'] != "ACTIVE":
 		print(f"deleting event {event.sort} | {event.title} as status {j_item['status']} is no longer ACTIVE...")
-		event.delete()
-		return False
-	
-	update_event_from_json(event, j_item)
-	event.save()
-	return True
+		return False, None
+	update_event_from_json(event, j_item, categorize=False)
+	return True, None if event.category else _categorize_text(j_item)
+
+def query_upcoming_events(attributes: list[str] | None = None) -> list[MeetupEvent]:
+	"""
+	Returns the current group's events that start in the future, reading only those rows.
+
+	Args:
+		attributes (list[str] | None): Only load these attributes, events loaded with a
+			projection must not be saved back.
+	"""
+	if attributes and 'meetup_group' not in attributes:
+		attributes = attributes + ['meetup_group']
+	group = groups.current()
+	return [event for event in shared.store.query_upcoming(attributes) if groups.of(event) is group]
+
+def recheck_stale_events(stale: list[MeetupEvent], save: bool = True) -> tuple[list[MeetupEvent], list[MeetupEvent]]:
+	"""
+	Re-scrapes events that are no longer in the RSS feed concurrently and categorizes those
+	without a category in one batch. No events are written, and with save=False neither is
+	the category cache.
+
+	Returns:
+		tuple[list[MeetupEvent], list[MeetupEvent]]: The events that are still active (updated
+		in memory, only those with changes), and the events that should be deleted.
+	"""
+	# the stale events may be projections, so load the full rows before they're written back
+	full_events = [event for event in shared.store.batch_get([event.sort for event in stale]).values() if event is not None]
+	pages = shared.http.map(lambda event: _meetup_url_to_json(_event_url(event.sort)), full_events)
+	to_save: list[MeetupEvent] = []
+	to_delete: list[MeetupEvent] = []
+	uncategorized: list[tuple[MeetupEvent, str]] = []
+	for event, j_item in zip(full_events, pages):
+		if isinstance(j_item, net.CircuitOpenError):
+			print(f"Deferred recheck of {event.sort} | {event.title} to the next run: {j_item}")
+			continue
+		try:
+			if isinstance(j_item, Exception):
+				raise j_item
+			result, text = _recheck_result(event, j_item)
+		except Exception:
+			print(f"Exception occured while rechecking {event.sort} | {event.title}:\n{get_stacktrace()}")
+			continue
+		if result:
+			if text:
+				uncategorized.append((event, text))
+			to_save.append(event)
+		elif result is False:
+			to_delete.append(event)
+	categorize_events(uncategorized, save)
+	return [event for event in to_save if event.changed_attributes()], to_delete
+
+def write_events(to_save: list[MeetupEvent], to_delete: list[MeetupEvent]):
+	"""
+	Writes events and deletes others (along with their discord events). New events and
+	deletions go out in one batch, stored events only get what changed (see MeetupEvent.save).
+	"""
+	for event in to_save:
+		if event._stored is None:
+			shared.store.put(event)
+			continue
+		# a batch put would bring back a row deleted since the event was loaded
+		try:
+			shared.store.update(event)
+		except MeetupEvent.DoesNotExist:
+			print(f"Not saving event {event.sort} | {event.title}, it was deleted in the meantime")
+	for event in to_delete:
+		shared.store.delete(event)
+	shared.store.flush()
+	for event in to_delete:
+		event.delete_discord_event()
 
 DO_AI_ENDPOINT = os.getenv('DO_AI_ENDPOINT')
 DO_AI_SECRET = os.getenv('DO_AI_SECRET')
+# how many events are sent to the LLM in a single batch request
+AI_BATCH_SIZE = 10
+# seconds to wait for a completion, the LLM is a lot slower than anything else we call
+AI_TIMEOUT = float(os.getenv('DO_AI_TIMEOUT', '60'))
+
+# words that give an event's category away without asking the LLM, matched on word boundaries
+category_keywords = {
+	"book club": ["book club", "reading", "novel", "light novel", "library"],
+	"conventions": ["convention", "con", "anime central", "acen", "expo", "cosplay"],
+	"food": ["dinner", "lunch", "brunch", "restaurant", "ramen", "sushi", "food", "cafe", "boba", "potluck", "bakery"],
+	"gaming": ["board game", "board games", "video game", "video games", "gaming", "mahjong", "tcg", "d&d", "dnd", "arcade"],
+	"karaoke": ["karaoke"],
+	"outdoor": ["picnic", "hike", "hiking", "park", "beach", "outdoor", "outdoors", "bike ride"],
+	"watch party": ["watch party", "screening", "movie", "movies", "film", "viewing"],
+	"volunteering": ["volunteer", "volunteering", "charity", "fundraiser", "cleanup"],
+}
+_keyword_patterns = {
+	category: re.compile(r"\b(" + "|".join(re.escape(word) for word in words) + r")\b")
+	for category, words in category_keywords.items()
+}
+
+def _normalize(text: str) -> str:
+	return " ".join(text.lower().split())
+
+def _category_key(text: str) -> int:
+	return sort_key(_normalize(text))
+
+def keyword_category(text: str) -> str | None:
+	"""
+	Cheap local classifier, returns a category only when the keywords clearly point at one.
+	Matches in the title (the first line) count double.
+	"""
+	title = _normalize(text.split("\n", 1)[0])
+	text = _normalize(text)
+	scores = {}
+	for category, pattern in _keyword_patterns.items():
+		score = len(pattern.findall(text)) + len(pattern.findall(title))
+		if score:
+			scores[category] = score
+	if len(scores) != 1:
+		return None
+	category, score = scores.popitem()
+	return category if score >= 2 else None
+
+def categorize_many(texts: list[str], save: bool = True) -> list[str | None]:
+	"""
+	Categorizes event texts, trying the category cache in the RallyBot table first, then the
+	keyword classifier, and sending whatever is left to the LLM in batches.
 
-def ai_categorize(description: str) -> str:
-	if not DO_AI_ENDPOINT or not DO_AI_SECRET:
+	Args:
+		texts (list[str]): Event titles and descriptions.
+		save (bool): Add the LLM's answers to the category cache.
+
+	Returns:
+		list[str | None]: A category for each text, in the same order. None if the text needed
+		the LLM and it's unreachable or failed for that text.
+	"""
+	results: list[str | None] = [None] * len(texts)
+	keys = [_category_key(text) for text in texts]
+	try:
+		cached = shared.store.get_categories(keys)
+	except Exception:
+		print(f"Couldn't read the category cache:\n{get_stacktrace()}")
+		cached = {}
+	pending = []
+	for i, text in enumerate(texts):
+		if cached.get(keys[i]) in categories:
+			results[i] = cached[keys[i]]
+		elif (category := keyword_category(text)):
+			results[i] = category
+		else:
+			pending.append(i)
+	if pending and (not DO_AI_ENDPOINT or not DO_AI_SECRET):
 		print("DigitalOcean AI endpoint/secret not set, defaulting to 'other' category.")
-		return 'other'
-	headers = {
+		for i in pending:
+			results[i] = 'other'
+		return results
+	learned = {}
+	for chunk_start in range(0, len(pending), AI_BATCH_SIZE):
+		chunk = pending[chunk_start:chunk_start + AI_BATCH_SIZE]
+		answers = _llm_categorize_batch([texts[i] for i in chunk]) if len(chunk) > 1 else [None]
+		for i, category in zip(chunk, answers):
+			try:
+				results[i] = category or _llm_categorize(texts[i])
+			except net.CircuitOpenError:
+				# left uncategorized, update_event_from_json asks again on the next run
+				continue
+			except Exception:
+				# only this one is left uncategorized, the rest of the batch (and what was learned) is kept
+				print(f"Couldn't categorize an event:\n{get_stacktrace()}")
+				continue
+			learned[keys[i]] = results[i]
+	if learned and save:
+		try:
+			shared.store.put_categories(learned)
+		except Exception:
+			print(f"Couldn't write the category cache:\n{get_stacktrace()}")
+	return results
+
+def ai_categorize(description: str) -> str | None:
+	return categorize_many([description])[0]
+
+def _ai_headers() -> dict:
+	return {
 		"Content-Type": "application/json",
 		"Authorization": f"Bearer {DO_AI_SECRET}"
 	}
+
+def _llm_categorize_batch(descriptions: list[str]) -> list[str | None]:
+	# one request for many events, events without a valid answer come back as None
+	events_text = "\n\n".join(f"Event {n}:\n{description}" for n, description in enumerate(descriptions, 1))
+	payload = {
+		"messages": [
+			{
+				"role": "user",
+				"content": f"{events_text}\n\nCategories: {', '.join(categories)}\n\n"
+					f"Pick the best category for each event. Answer with exactly one line per event in the form '<event number>: <category>'."
+			}
+		],
+		"stream": False,
+		"include_functions_info": False,
+		"include_retrieval_info": False,
+		"include_guardrails_info": False
+	}
+	try:
+		response = shared.http.post(f"{DO_AI_ENDPOINT}/api/v1/chat/completions", json=payload, headers=_ai_headers(), timeout=AI_TIMEOUT)
+		response.raise_for_status()  # Raise an exception for HTTP errors
+		content = response.json()['choices'][0]['message']['content']
+	except Exception:
+		print(f"Batch categorization failed, categorizing one by one:\n{get_stacktrace()}")
+		return [None] * len(descriptions)
+	answers: list[str | None] = [None] * len(descriptions)
+	for match in re.finditer(r"^\s*(?:event\s*)?(\d+)\s*[:.)-]\s*(.+?)\s*$", content, re.IGNORECASE | re.MULTILINE):
+		n, category = int(match.group(1)), match.group(2).lower().strip("*'\" ")
+		if 1 <= n <= len(descriptions) and category in categories:
+			answers[n - 1] = category
+	return answers
+
+def _llm_categorize(description: str) -> str:
+	headers = _ai_headers()
 	payload = {
 		"messages": [
 			{
@@ -241,7 +695,7 @@ def ai_categorize(description: str) -> str:
 		"include_retrieval_info": False,
 		"include_guardrails_info": False
 	}
-	response = requests.post(f"{DO_AI_ENDPOINT}/api/v1/chat/completions", json=payload, headers=headers)
+	response = shared.http.post(f"{DO_AI_ENDPOINT}/api/v1/chat/completions", json=payload, headers=headers, timeout=AI_TIMEOUT)
 	response.raise_for_status()  # Raise an exception for HTTP errors
 	message = response.json()['choices'][0]['message']
 	cat = message['content'].lower()
@@ -252,7 +706,7 @@ def ai_categorize(description: str) -> str:
 			"content": f"{cat} is not a valid answer. select the best category from the following list: {', '.join(categories)}"
 		})
 		print(f"invalid category {cat}, retrying...")
-		response = requests.post(f"{DO_AI_ENDPOINT}/api/v1/chat/completions", json=payload, headers=headers)
+		response = shared.http.post(f"{DO_AI_ENDPOINT}/api/v1/chat/completions", json=payload, headers=headers, timeout=AI_TIMEOUT)
 		response.raise_for_status()  # Raise an exception for HTTP errors
 		message = response.json()['choices'][0]['message']
 		cat = message['content'].lower()
@@ -262,9 +716,9 @@ def ai_categorize(description: str) -> str:
 	return cat
 
 if __name__ == "__main__":
-	from time import sleep
-	for event in MeetupEvent.scan(index_name="timestamp-index", filter_condition=MeetupEvent.timestamp > int(dt.datetime.now(shared.est).timestamp() * 1000)):
-		j_item = _meetup_url_to_json(f"https://www.meetup.com/chicago-anime-hangouts/events/{event.sort}/")
-		print(f"DEBUG: rechecked event {event.sort} | {event.title} status: {j_item['status']}")
-		sleep(5)
-		# check_existing_event(event)
\ No newline at end of file
+	# rechecks every upcoming event against its page without writing anything
+	to_save, to_delete = recheck_stale_events(query_upcoming_events(), save=False)
+	for event in to_save:
+		print(f"DEBUG: event {event.sort} | {event.title} changed: {', '.join(event.changed_attributes())}")
+	for event in to_delete:
+		print(f"DEBUG: event {event.sort} | {event.title} would be deleted")
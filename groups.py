@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+from traceback import format_exc as get_stacktrace
+
+# JSON file with a list of {"meetup_group", "guild_id", "in_person_mention", "online_mention"} objects
+GROUPS_FILE = os.getenv('RALLY_GROUPS')
+# how many groups are synced at the same time
+SYNC_WORKERS = int(os.getenv('RALLY_SYNC_WORKERS', '2'))
+
+DEFAULT_GROUPS = [
+	{
+		"meetup_group": "chicago-anime-hangouts",
+		"guild_id": "1219601473948614737",
+		"in_person_mention": "<@&1366086187906895923>",
+		"online_mention": "<@&1366085997917638826>",
+	},
+]
+
+class Group:
+	"""
+	A Meetup group and the Discord guild its events are mirrored to.
+	"""
+	def __init__(self, meetup_group: str, guild_id: str, in_person_mention: str, online_mention: str):
+		self.meetup_group = meetup_group
+		self.guild_id = int(guild_id)
+		self.in_person_mention = in_person_mention
+		self.online_mention = online_mention
+		self.guild = None
+		self.channels: dict = None
+		# time.monotonic() of the last finished sync, the pool syncs the longest waiting group first
+		self.last_synced = 0.0
+
+	@property
+	def rss_url(self) -> str:
+		return f"https://www.meetup.com/{self.meetup_group}/events/rss"
+
+	def event_url(self, guid) -> str:
+		return f"https://www.meetup.com/{self.meetup_group}/events/{guid}/"
+
+	def __str__(self) -> str:
+		return f"{self.meetup_group} -> {self.guild_id}"
+
+def load() -> list[Group]:
+	if not GROUPS_FILE:
+		return [Group(**config) for config in DEFAULT_GROUPS]
+	with open(GROUPS_FILE) as f:
+		return [Group(**config) for config in json.load(f)]
+
+GROUPS = load()
+by_name = {group.meetup_group: group for group in GROUPS}
+by_guild = {group.guild_id: group for group in GROUPS}
+
+# the group the running task works on, copied into the I/O executor by shared.run_blocking
+_current: contextvars.ContextVar[Group | None] = contextvars.ContextVar('group', default=None)
+
+def current() -> Group:
+	# anything that runs outside a group's context (the debug entry points, a single group setup) uses the first group
+	return _current.get() or GROUPS[0]
+
+@contextmanager
+def use(group: Group):
+	token = _current.set(group)
+	try:
+		yield group
+	finally:
+		_current.reset(token)
+
+def named(meetup_group: str | None) -> Group:
+	# rows written before there were several groups have no group, they belong to the first one
+	return by_name.get(meetup_group) or GROUPS[0]
+
+def of(event) -> Group:
+	return named(getattr(event, 'meetup_group', None))
+
+class SyncPool:
+	"""
+	Runs group syncs on a fixed number of workers. Queued groups go out longest waiting first
+	and a group is never queued twice, so one slow group can't hold up the others.
+	"""
+	def __init__(self, workers: int = SYNC_WORKERS):
+		self.workers = max(1, workers)
+		self._queue: asyncio.PriorityQueue = None
+		self._order = itertools.count()
+		self._pending: set[str] = set()
+
+	def _start(self):
+		if self._queue is None:
+			self._queue = asyncio.PriorityQueue()
+			loop = asyncio.get_running_loop()
+			for _ in range(self.workers):
+				loop.create_task(self._work())
+
+	def enqueue(self, groups: list[Group], sync) -> int:
+		"""
+		Queues `sync` for each group that isn't already queued or running.
+
+		Args:
+			groups (list[Group]): The groups to sync.
+			sync: Coroutine function run with the group as the current group.
+
+		Returns:
+			int: How many groups were queued.
+		"""
+		self._start()
+		queued = 0
+		for group in groups:
+			if group.meetup_group in self._pending:
+				print(f"{group} is still waiting for (or running) its last sync, skipping")
+				continue
+			self._pending.add(group.meetup_group)
+			self._queue.put_nowait((group.last_synced, next(self._order), group, sync))
+			queued += 1
+		return queued
+
+	async def run(self, groups: list[Group], sync):
+		# queue the groups and wait until every queued sync has finished
+		self.enqueue(groups, sync)
+		await self._queue.join()
+
+	async def _work(self):
+		while True:
+			_, _, group, sync = await self._queue.get()
+			try:
+				with use(group):
+					await sync()
+			except Exception:
+				print(f"Exception occured while syncing {group}:\n{get_stacktrace()}")
+			finally:
+				group.last_synced = time.monotonic()
+				self._pending.discard(group.meetup_group)
+				self._queue.task_done()
@@ -0,0 +1,119 @@
+from aws import RallyBotModel, sort_key
+import groups
+
+import os
+import math
+import time
+import uuid
+import socket
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.exceptions import PutError, DeleteError
+
+# set to split the groups between several running bots, each group is synced by whichever bot holds its lease
+LEASES = not not os.getenv('RALLY_LEASES')
+# a lease (or replica heartbeat) not renewed for this long is up for grabs
+LEASE_SECONDS = int(os.getenv('RALLY_LEASE_SECONDS', '90'))
+REPLICA_ID = os.getenv('RALLY_REPLICA_ID') or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+class Lease(RallyBotModel):
+	"""
+	id 'lease' rows say which replica syncs a group (data is the group's name), id 'replica'
+	rows are each replica's heartbeat.
+	"""
+	owner = UnicodeAttribute(null=True)
+	expires = NumberAttribute(null=True)
+
+class LeaseManager:
+	"""
+	Splits the configured groups evenly between the live replicas. Without RALLY_LEASES
+	this replica owns every group and nothing is written.
+	"""
+	def __init__(self, replica_id: str = REPLICA_ID, seconds: int = LEASE_SECONDS, enabled: bool = LEASES):
+		self.replica_id = replica_id
+		self.seconds = seconds
+		self.enabled = enabled
+		self.owned: set[str] = set() if enabled else {group.meetup_group for group in groups.GROUPS}
+
+	def owns(self, group: groups.Group) -> bool:
+		return group.meetup_group in self.owned
+
+	def owned_groups(self) -> list[groups.Group]:
+		return [group for group in groups.GROUPS if self.owns(group)]
+
+	def _claim(self, name: str, now: float) -> bool:
+		lease = Lease(id='lease', sort=sort_key(name), data=name, owner=self.replica_id, expires=now + self.seconds)
+		try:
+			# free, already ours, or its owner stopped renewing it
+			lease.save(condition=Lease.owner.does_not_exist() | (Lease.owner == self.replica_id) | (Lease.expires < now))
+			return True
+		except PutError as e:
+			if e.cause_response_code == 'ConditionalCheckFailedException':
+				return False
+			raise
+
+	def _release(self, name: str):
+		try:
+			Lease(id='lease', sort=sort_key(name)).delete(condition=Lease.owner == self.replica_id)
+		except DeleteError as e:
+			if e.cause_response_code != 'ConditionalCheckFailedException':
+				raise
+
+	def _remove_replica(self, replica: Lease, now: float):
+		# a replica that stopped without close(), unless it came back in the meantime
+		try:
+			replica.delete(condition=Lease.expires < now)
+			print(f"removed the heartbeat of stopped replica {replica.data}")
+		except DeleteError as e:
+			if e.cause_response_code != 'ConditionalCheckFailedException':
+				raise
+
+	def heartbeat(self) -> set[str]:
+		"""
+		Renews this replica's heartbeat and leases, gives up leases above its fair share and
+		claims free ones up to it. Runs every LEASE_SECONDS / 3.
+
+		Returns:
+			set[str]: The names of the groups this replica owns now.
+		"""
+		if not self.enabled:
+			return self.owned
+		now = time.time()
+		Lease(id='replica', sort=sort_key(self.replica_id), data=self.replica_id, owner=self.replica_id, expires=now + self.seconds).save()
+		replicas = 0
+		for replica in Lease.query('replica'):
+			if replica.expires and replica.expires > now:
+				replicas += 1
+			else:
+				self._remove_replica(replica, now)
+		share = math.ceil(len(groups.GROUPS) / max(1, replicas))
+		owned, released = set(), set()
+		# renew what we hold first so groups don't move between replicas without a reason
+		names = sorted(group.meetup_group for group in groups.GROUPS)
+		for name in sorted(names, key=lambda name: name not in self.owned):
+			if len(owned) >= share:
+				if name in self.owned:
+					print(f"releasing the lease on {name}, {replicas} replicas are sharing {len(names)} groups")
+					self._release(name)
+					released.add(name)
+				continue
+			if self._claim(name, now):
+				owned.add(name)
+		for name in owned - self.owned:
+			print(f"took the lease on {name}")
+		for name in self.owned - owned - released:
+			print(f"lost the lease on {name}")
+		self.owned = owned
+		return owned
+
+	def close(self):
+		"""
+		Gives up this replica's leases and heartbeat on shutdown, so the other replicas
+		take its groups over at their next heartbeat instead of after LEASE_SECONDS.
+		"""
+		if not self.enabled:
+			return
+		for name in self.owned:
+			self._release(name)
+		self.owned = set()
+		Lease(id='replica', sort=sort_key(self.replica_id)).delete()
+		print(f"removed the heartbeat of replica {self.replica_id}")
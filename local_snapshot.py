@@ -0,0 +1,64 @@
+from shared import CACHE_DIR
+import groups
+
+import os
+import json
+import threading
+
+# last known state of every upcoming event with a discord event, so reminders work before the first sync
+SNAPSHOT_PATH = os.path.join(CACHE_DIR, 'events.json')
+FIELDS = ['sort', 'snowflake_id', 'title', 'timestamp', 'online', 'category', 'meetup_group']
+
+_events: dict[int, dict] = {}
+_lock = threading.Lock()
+
+def _row(event) -> dict:
+	return {field: getattr(event, field, None) for field in FIELDS}
+
+def load() -> list[dict]:
+	"""
+	Reads the snapshot file into memory.
+
+	Returns:
+		list[dict]: The stored events, each with the FIELDS attributes.
+	"""
+	try:
+		with open(SNAPSHOT_PATH) as f:
+			rows = json.load(f)
+	except (OSError, ValueError):
+		rows = []
+	with _lock:
+		_events.clear()
+		for row in rows:
+			_events[int(row['snowflake_id'])] = row
+	return rows
+
+def replace(events: list, group: groups.Group):
+	# the full set of a group's upcoming events is known, e.g. just after querying dynamodb
+	with _lock:
+		for snowflake_id, row in list(_events.items()):
+			if groups.named(row.get('meetup_group')) is group:
+				del _events[snowflake_id]
+		for event in events:
+			if event.snowflake_id:
+				_events[int(event.snowflake_id)] = _row(event)
+	save()
+
+def upsert(event):
+	if event.snowflake_id:
+		with _lock:
+			_events[int(event.snowflake_id)] = _row(event)
+
+def remove(snowflake_id):
+	with _lock:
+		_events.pop(int(snowflake_id), None)
+
+def save():
+	with _lock:
+		rows = list(_events.values())
+	os.makedirs(CACHE_DIR, exist_ok=True)
+	# write then rename, so a crash never leaves half a file behind
+	temp_path = f"{SNAPSHOT_PATH}.tmp"
+	with open(temp_path, 'w') as f:
+		json.dump(rows, f)
+	os.replace(temp_path, SNAPSHOT_PATH)
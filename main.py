@@ -1,144 +1,221 @@
+from __future__ import annotations
+import time
+STARTED = time.perf_counter()
+
 import discord
 
 from shared import shared
-import events
+import groups
+import metrics
 
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import os
-import datetime
+import asyncio
+import importlib
 from traceback import format_exc as get_stacktrace
 
+# events, reconcile and reminders pull in boto3, pynamodb and requests, see load_modules
+events = None
+reconcile = None
+pipeline = None
+reminders = None
+local_snapshot = None
+leases = None
+lease_manager = None
+pool = groups.SyncPool()
+_modules_loaded: asyncio.Future = None
+_initial_sync: asyncio.Task = None
+
 intents = discord.Intents.default()
 # required intents for the bot to function
 intents.guild_scheduled_events = True
 intents.guild_messages = True
 
 client = discord.Client(intents=intents)
-IN_PERSON_MENTION = "<@&1366086187906895923>"
-ONLINE_MENTION = "<@&1366085997917638826>"
+# print what a sync would change instead of changing it
+DRY_RUN = not not os.getenv('RALLY_DRY_RUN')
+# sync every N minutes instead of once a day when set
+SYNC_MINUTES = int(os.getenv('RALLY_SYNC_MINUTES', '0'))
 
 async def set_globals():
 	shared.client = client
-	shared.guild = await client.fetch_guild("1219601473948614737")
+	guilds = await asyncio.gather(*(client.fetch_guild(group.guild_id) for group in groups.GROUPS))
+	for group, guild in zip(groups.GROUPS, guilds):
+		group.guild = guild
+
+async def load_modules():
+	"""
+	Imports the heavy modules on the I/O executor so the gateway connection isn't held up by them.
+	Safe to call from anywhere, the import only happens once.
+	"""
+	global events, reconcile, pipeline, reminders, local_snapshot, leases, lease_manager, _modules_loaded
+	if _modules_loaded is None:
+		_modules_loaded = asyncio.ensure_future(shared.run_blocking(
+			lambda: [importlib.import_module(name) for name in ('events', 'reconcile', 'pipeline', 'reminders', 'local_snapshot', 'leases')]))
+	events, reconcile, pipeline, reminders, local_snapshot, leases = await asyncio.shield(_modules_loaded)
+	if lease_manager is None:
+		lease_manager = leases.LeaseManager()
 
 async def update_events():
-	on_meetup = events.fetch_meetup_events()
-	for event in on_meetup:
-		discord_event: (discord.ScheduledEvent | None) = None
-		if event.snowflake_id:
-			discord_event = None
-			try:
-				discord_event = await shared.guild.fetch_scheduled_event(event.snowflake_id)
-			except discord.errors.NotFound as e:
-				print(f"Invalid snowflake value for {event.title}, this has likely been deleted from discord, recreating...")
-			except Exception as e:
-				print(f"Exception occured while processing {event.title} ({event.id} | {event.snowflake_id}):\n{get_stacktrace()}")
-				continue
-		if discord_event:
-			# check if the event needs updating
-			updates = {}
-			if discord_event.name != event.title:
-				print(f"{discord_event.name} -> {event.title}")
-				updates['name'] = event.title
-			if discord_event.description != event.description:
-				print(f"{discord_event.description} -> {event.description}")
-				updates['description'] = event.description
-			if discord_event.start_time != event.start_time:
-				print(f"{discord_event.start_time} -> {event.start_time}")
-				updates['start_time'] = event.start_time
-			# use the explicit endtime if it exists and is set, otherwise its implicitly an hour long
-			if hasattr(event, 'endtime') and event.endtime and discord_event.end_time != event.endtime:
-				updates['end_time'] = event.endtime
-				if discord_event.start_time > updates['end_time']:
-					# this is weird, the end time is after the start time???
-					print(f"this is weird, this is weird, the end time is after the start time???\n{discord_event.start_time} -> {updates['end_time']}\n{event.start_time} -> {event.endtime}")
-					updates['start_time'] = event.start_time
-			if discord_event.location != event.location:
-				print(f"{discord_event.location} -> {event.location}")
-				updates['location'] = event.location
-			if len(updates) > 0:
-				try:
-					await discord_event.edit(**updates)
-					event.save()
-				except Exception as e:
-					print(f"Exception occured while updating \n{event} \n{discord_event}\n<- {updates} :\n{get_stacktrace()}")
-					continue
-				category = get_channel_for_ddb_event(event)
-				target_role = ONLINE_MENTION if event.online else IN_PERSON_MENTION
-				await shared.message_channel(category, f"{target_role} {event.title} has been updated.")
-				print(f"Updated discord event {event.sort} | {event.title}")
-			else:
-				print(f"{event.title} already exists.")
-		else:
-			# has not been created, so create it
-			discord_event = await shared.guild.create_scheduled_event(
-				name=event.title,
-				description=event.description,
-				start_time=event.start_time,
-				end_time=event.endtime if hasattr(event, 'endtime') and event.endtime else (event.start_time + datetime.timedelta(hours=1)),
-				location=event.location,
-				entity_type=discord.EntityType.external,
-				privacy_level=discord.PrivacyLevel.guild_only
-			)
-			event.snowflake_id = discord_event.id
-			event.save()
-			print(f"Created new event w/ snowflake id: {event.snowflake_id}")
-			await notify_new_event(event)
-	# check for cancelled events and remove them from ddb
-	hashed_ids: set[int] = set(map(lambda event: event.sort, on_meetup))
-	for event in events.MeetupEvent.scan(index_name="timestamp-index", filter_condition=events.MeetupEvent.timestamp > int(datetime.datetime.now(shared.est).timestamp() * 1000)):
-		if event.sort not in hashed_ids:
-			print(f"rechecking event {event.sort} | {event.title} ...")
-			events.check_existing_event(event)
-
-def get_channel_for_ddb_event(event: events.MeetupEvent):
-	if not event:
-		return 'events-general'
-	category = event.category
-	if category not in events.categories:
-		category = 'other'
-	if category == 'other':
-		category = 'events-general'
-	return category
+	timings = metrics.snapshot()
+	read_units = shared.store.read_units
+	if DRY_RUN:
+		# the whole plan is worked out before anything is printed
+		snapshot = await reconcile.take_snapshot()
+		actions = reconcile.plan(snapshot)
+		reconcile.print_plan(actions)
+		applied = len(actions)
+	else:
+		applied = await pipeline.sync()
+	print(f"Finished syncing {groups.current()} ({applied} actions), worst event loop lag was {shared.loop_lag.take_max() * 1000:.0f}ms")
+	if shared.http.cache:
+		print(f"HTTP cache: {shared.http.cache.stats()}")
+	print(f"Outbound hosts: {shared.http.stats()}")
+	print(f"Discord outbox: {shared.outbox.stats()}")
+	# other groups syncing at the same time show up here too
+	print(f"Storage requests: {dict(shared.store.requests)}, {shared.store.read_units - read_units:.1f} DynamoDB read units this run")
+	print(f"Message dedup: {shared.dedup.stats()}")
+	if metrics.ENABLED:
+		# other groups syncing at the same time show up here too
+		print(f"Sync timings for {groups.current()}: {metrics.summary(timings)}")
 
 async def notify_new_event(event: events.MeetupEvent):
-	category = get_channel_for_ddb_event(event)
-	target_role = ONLINE_MENTION if event.online else IN_PERSON_MENTION
+	category = reconcile.get_channel_for_ddb_event(event)
+	target_role = reconcile.mention_for(event)
 	await shared.message_channel(category, f"{target_role} {event.title} has been scheduled for <t:{round(event.start_time.timestamp())}>.")
 
 async def notify_events():
-	discord_events = await shared.guild.fetch_scheduled_events()
-	now = datetime.datetime.now(shared.est)
+	"""
+	Catches up after a restart: adopts discord events created while we were offline and
+	schedules the reminder for every upcoming event.
+	"""
+	with metrics.span('discord_fetch'):
+		discord_events = await shared.guild.fetch_scheduled_events()
+	read_units = shared.store.read_units
+	by_snowflake = await shared.run_blocking(events.load_snowflake_index)
+	print(f"Loaded {len(by_snowflake)} events by snowflake using {shared.store.read_units - read_units:.1f} DynamoDB read units")
 	for de in discord_events:
-		ddb_event: events.MeetupEvent | None = events.MeetupEvent.scan(index_name="snowflake_id-index", filter_condition=events.MeetupEvent.snowflake_id == de.id).next()
-		if not ddb_event and de.status == discord.EventStatus.scheduled:
-			ddb_event = events.MeetupEvent.from_discord_event(de)
+		if de.id not in by_snowflake and de.status == discord.EventStatus.scheduled:
+			ddb_event = await shared.run_blocking(events.MeetupEvent.from_discord_event, de)
+			await notify_new_event(ddb_event)
+	await reminders.restore(discord_events)
+
+async def _group_for(de: discord.ScheduledEvent) -> groups.Group | None:
+	# the group of a guild this replica looks after, None for anything else
+	group = groups.by_guild.get(de.guild_id)
+	if group is None or group.guild is None:
+		return None
+	await load_modules()
+	return group if lease_manager.owns(group) else None
+
+def _created_elsewhere(de: discord.ScheduledEvent) -> bool:
+	# events the bot makes itself are handled by update_events
+	return de.creator_id != client.user.id
+
+@client.event
+async def on_scheduled_event_create(de: discord.ScheduledEvent):
+	if not _created_elsewhere(de) or de.status != discord.EventStatus.scheduled:
+		return
+	group = await _group_for(de)
+	if not group:
+		return
+	with groups.use(group):
+		ddb_event = await shared.run_blocking(events.find_by_snowflake, de.id)
+		if not ddb_event:
+			ddb_event = await shared.run_blocking(events.MeetupEvent.from_discord_event, de)
 			await notify_new_event(ddb_event)
-			continue
-		
-		# handle categories
-		category = get_channel_for_ddb_event(ddb_event)
-		
-		# event is in-person and starts sometime between 24 and 25 hours from now
-		if not ddb_event.online and de.start_time > (now+datetime.timedelta(hours=24)) and de.start_time < (now+datetime.timedelta(hours=25)):
-			await shared.message_channel(category, f"{IN_PERSON_MENTION} {de.name} is tomorrow! (<t:{round(de.start_time.timestamp())}>)")
-		# event is online and starts sometime between 1 and 2 hours from now
-		elif ddb_event.online and de.start_time > (now+datetime.timedelta(hours=1)) and de.start_time < (now+datetime.timedelta(hours=2)):
-			await shared.message_channel(category, f"{ONLINE_MENTION} {de.name} starts soon! (<t:{round(de.start_time.timestamp())}:t>)")
+		reminders.schedule(ddb_event)
+		local_snapshot.upsert(ddb_event)
 
 @client.event
-async def on_ready():
-	await set_globals()
-	print(f'We have logged in as {client.user}')
-	
-	# Run update_events once at startup
+async def on_scheduled_event_update(before: discord.ScheduledEvent, after: discord.ScheduledEvent):
+	if not _created_elsewhere(after) or before.start_time == after.start_time:
+		return
+	group = await _group_for(after)
+	if not group:
+		return
+	with groups.use(group):
+		ddb_event = await shared.run_blocking(events.find_by_snowflake, after.id)
+		if ddb_event:
+			ddb_event.start_time = after.start_time
+			await shared.run_blocking(shared.store.update, ddb_event)
+			reminders.schedule(ddb_event)
+			local_snapshot.upsert(ddb_event)
+
+@client.event
+async def on_scheduled_event_delete(de: discord.ScheduledEvent):
+	group = await _group_for(de)
+	if not group:
+		return
+	with groups.use(group):
+		reminders.cancel(de.id)
+		local_snapshot.remove(de.id)
+
+async def catch_up():
 	await update_events()
+	# reminders are one-shot jobs at each event's exact reminder time, kept up to date by update_events
+	await notify_events()
+
+async def sync_groups():
+	# every group this replica owns, at most groups.SYNC_WORKERS at a time
+	await pool.run(lease_manager.owned_groups(), update_events)
+
+async def heartbeat():
+	"""
+	Renews this replica's leases. Groups it just took over get a full catch-up, the reminders
+	of groups it gave up are cancelled so they aren't sent twice.
+	"""
+	before = set(lease_manager.owned)
+	try:
+		owned = await shared.run_blocking(lease_manager.heartbeat)
+	except Exception:
+		print(f"Exception occured while renewing leases:\n{get_stacktrace()}")
+		return
+	for name in before - owned:
+		reminders.cancel_group(name)
+	gained = [group for group in groups.GROUPS if group.meetup_group in owned - before]
+	if gained and _initial_sync and _initial_sync.done():
+		pool.enqueue(gained, catch_up)
 
-	# Schedule update_events to run daily at 12:30 PM
-	shared.scheduler.add_job(update_events, CronTrigger(hour=12, minute=30, timezone="America/Chicago"), max_instances=1)
-	# Schedule notify events to run every hour on the hour
-	shared.scheduler.add_job(notify_events, CronTrigger(minute=0), max_instances=1)
+async def initial_sync():
+	try:
+		await pool.run(lease_manager.owned_groups(), catch_up)
+	except Exception:
+		print(f"Exception occured during the initial sync:\n{get_stacktrace()}")
+	print(f"Initial sync finished {time.perf_counter() - STARTED:.2f}s after start")
+
+@client.event
+async def on_ready():
+	print(f'We have logged in as {client.user} {time.perf_counter() - STARTED:.2f}s after start')
+	shared.loop_lag.start(shared.loop)
+	if metrics.METRICS_PORT:
+		metrics.serve()
+	await asyncio.gather(set_globals(), load_modules())
+	if lease_manager.enabled:
+		await heartbeat()
+		shared.scheduler.add_job(heartbeat, IntervalTrigger(seconds=lease_manager.seconds / 3), max_instances=1)
+	# the last known events are enough to get reminders going before anything has been synced
+	reminders.restore_from_snapshot(lease_manager.owned)
+
+	if SYNC_MINUTES:
+		# unchanged pages are cheap thanks to the HTTP cache, so syncs can run every few minutes
+		shared.scheduler.add_job(sync_groups, IntervalTrigger(minutes=SYNC_MINUTES), max_instances=1)
+	else:
+		# Schedule the sync to run daily at 12:30 PM
+		shared.scheduler.add_job(sync_groups, CronTrigger(hour=12, minute=30, timezone="America/Chicago"), max_instances=1)
 	shared.scheduler.start()
-	print("Successfully scheduled jobs.")
+	print(f"Successfully scheduled jobs, ready {time.perf_counter() - STARTED:.2f}s after start.")
+	# the first sync runs in the background, the bot is responsive in the meantime
+	global _initial_sync
+	_initial_sync = shared.loop.create_task(initial_sync())
 
-client.run(os.getenv('DISCORD_TOKEN'))
+if __name__ == "__main__":
+	try:
+		client.run(os.getenv('DISCORD_TOKEN'))
+	finally:
+		if lease_manager is not None:
+			try:
+				lease_manager.close()
+			except Exception:
+				print(f"Exception occured while giving up leases:\n{get_stacktrace()}")
@@ -0,0 +1,66 @@
+import re
+import json
+
+_next_data_tag = re.compile(r'<script[^>]*\bid=["\']__NEXT_DATA__["\'][^>]*>')
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'\s*')
+
+def _looks_like_event(value) -> bool:
+	return isinstance(value, dict) and all(key in value for key in ('title', 'eventUrl', 'status'))
+
+def _is_event(value, event_id: str | None) -> bool:
+	# pageProps can hold other events (series, related events) before the page's own one
+	if not _looks_like_event(value):
+		return False
+	return event_id is None or str(value.get('id')) == event_id or f"/events/{event_id}/" in str(value['eventUrl'])
+
+def extract_event_fast(html: str, event_id: str | None = None) -> dict | None:
+	"""
+	Pulls props.pageProps.event out of a Meetup event page without building a DOM.
+
+	Args:
+		html (str): The event page.
+		event_id (str | None): The id of the page's event, the first event object found is
+			only trusted if it's this one.
+
+	Returns:
+		dict | None: The event, or None if the page isn't laid out the way we expect.
+	"""
+	tag = _next_data_tag.search(html)
+	if not tag:
+		return None
+	start = tag.end()
+	end = html.find('</script>', start)
+	if end == -1:
+		return None
+	# jump straight to the event object and decode only that subtree
+	page_props = html.find('"pageProps":', start, end)
+	key = html.find('"event":', page_props, end) if page_props != -1 else -1
+	if key != -1:
+		idx = _whitespace.match(html, key + len('"event":')).end()
+		try:
+			event, _ = _decoder.raw_decode(html, idx)
+			if _is_event(event, event_id):
+				return event
+		except ValueError:
+			pass
+	# the first "event" key wasn't the one we wanted, decode the whole payload instead
+	try:
+		event = json.loads(html[start:end])['props']['pageProps']['event']
+	except (ValueError, KeyError, TypeError):
+		return None
+	return event if _looks_like_event(event) else None
+
+def extract_event_soup(html: str) -> dict:
+	from bs4 import BeautifulSoup
+	soup = BeautifulSoup(html, features="lxml")
+	j_item: dict = json.loads(soup.select_one('script#__NEXT_DATA__').text)
+	return j_item['props']['pageProps']['event']
+
+def extract_event(html: str, event_id: str | None = None) -> dict:
+	event = extract_event_fast(html, event_id)
+	if event is None:
+		# the page layout changed in a way the fast path doesn't understand, use the full parser
+		print("WARNING: falling back to BeautifulSoup to read __NEXT_DATA__")
+		event = extract_event_soup(html)
+	return event
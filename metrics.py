@@ -0,0 +1,132 @@
+import os
+import time
+import bisect
+import threading
+
+# serve the metrics below in the Prometheus text format on this port, 0 leaves the endpoint off
+METRICS_PORT = int(os.getenv('RALLY_METRICS_PORT', '0'))
+# only reachable from this machine unless set to e.g. 0.0.0.0
+METRICS_HOST = os.getenv('RALLY_METRICS_HOST', '127.0.0.1')
+# timing is on whenever the endpoint is, RALLY_METRICS turns it on for the per-run summary alone
+ENABLED = bool(METRICS_PORT) or not not os.getenv('RALLY_METRICS')
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Stage:
+	def __init__(self):
+		self.count = 0
+		self.errors = 0
+		self.total = 0.0
+		# one more than BUCKETS for everything slower than the last bound
+		self.buckets = [0] * (len(BUCKETS) + 1)
+
+_stages: dict[str, Stage] = {}
+_lock = threading.Lock()
+
+def observe(stage: str, seconds: float, failed: bool = False):
+	with _lock:
+		stats = _stages.get(stage)
+		if stats is None:
+			stats = _stages[stage] = Stage()
+		stats.count += 1
+		stats.errors += failed
+		stats.total += seconds
+		stats.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+class Span:
+	__slots__ = ('stage', 'start')
+
+	def __init__(self, stage: str):
+		self.stage = stage
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		observe(self.stage, time.perf_counter() - self.start, exc_type is not None)
+		return False
+
+class _NoSpan:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		return False
+
+_no_span = _NoSpan()
+
+def span(stage: str):
+	"""
+	Times a block as one call of a stage, an exception leaving the block counts as an error.
+	When metrics are off this hands back a shared do-nothing context manager.
+
+		with metrics.span('rss_fetch'):
+			...
+	"""
+	if not ENABLED:
+		return _no_span
+	return Span(stage)
+
+def snapshot() -> dict[str, tuple[int, float, int]]:
+	# stage -> (calls, seconds, errors), pass it to summary() to describe everything since
+	with _lock:
+		return {stage: (stats.count, stats.total, stats.errors) for stage, stats in _stages.items()}
+
+def summary(since: dict[str, tuple[int, float, int]] | None = None) -> str:
+	since = since or {}
+	parts = []
+	for stage, (count, total, errors) in sorted(snapshot().items()):
+		before = since.get(stage, (0, 0.0, 0))
+		count, total, errors = count - before[0], total - before[1], errors - before[2]
+		if count:
+			parts.append(f"{stage} {count}x {total:.2f}s" + (f" ({errors} failed)" if errors else ""))
+	return ", ".join(parts) or "nothing timed"
+
+def render() -> str:
+	lines = [
+		"# HELP rally_stage_seconds Time spent in each stage of a sync.",
+		"# TYPE rally_stage_seconds histogram",
+	]
+	with _lock:
+		stages = sorted((stage, stats.count, stats.errors, stats.total, list(stats.buckets)) for stage, stats in _stages.items())
+	for stage, count, _, total, buckets in stages:
+		cumulative = 0
+		for bound, n in zip(BUCKETS, buckets):
+			cumulative += n
+			lines.append(f'rally_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+		lines.append(f'rally_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+		lines.append(f'rally_stage_seconds_sum{{stage="{stage}"}} {total}')
+		lines.append(f'rally_stage_seconds_count{{stage="{stage}"}} {count}')
+	lines.append("# HELP rally_stage_errors_total Calls of each stage that raised.")
+	lines.append("# TYPE rally_stage_errors_total counter")
+	for stage, _, errors, _, _ in stages:
+		lines.append(f'rally_stage_errors_total{{stage="{stage}"}} {errors}')
+	return "\n".join(lines) + "\n"
+
+def serve(port: int = METRICS_PORT):
+	"""
+	Serves render() at http://<METRICS_HOST>:<port>/metrics from a background thread.
+	"""
+	from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path != '/metrics':
+				self.send_error(404)
+				return
+			body = render().encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = ThreadingHTTPServer((METRICS_HOST, port), Handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name="rally-metrics", daemon=True).start()
+	print(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+	return server
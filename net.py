@@ -0,0 +1,287 @@
+import os
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from shared import CACHE_DIR
+
+# maximum number of requests in flight to a single host at once
+PER_HOST_LIMIT = int(os.getenv('RALLY_PER_HOST_LIMIT', '4'))
+# size bound of the on-disk HTTP cache, 0 turns it off
+HTTP_CACHE_MB = float(os.getenv('RALLY_HTTP_CACHE_MB', '64'))
+# seconds to wait on a host before giving up, RALLY_HOST_TIMEOUTS overrides it per host ("www.meetup.com=10,example.com=60")
+TIMEOUT = float(os.getenv('RALLY_HTTP_TIMEOUT', '15'))
+HOST_TIMEOUTS = {host: float(seconds) for host, _, seconds in (entry.partition('=') for entry in os.getenv('RALLY_HOST_TIMEOUTS', '').split(',') if entry)}
+# extra attempts for timeouts, connection errors and RETRY_STATUSES, with jittered exponential backoff
+RETRIES = int(os.getenv('RALLY_HTTP_RETRIES', '2'))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF = 0.5
+BACKOFF_MAX = 8.0
+# a host that fails this many calls in a row is skipped for BREAKER_SECONDS, then tried with a single call
+BREAKER_FAILURES = int(os.getenv('RALLY_BREAKER_FAILURES', '5'))
+BREAKER_SECONDS = float(os.getenv('RALLY_BREAKER_SECONDS', '60'))
+
+class CircuitOpenError(requests.RequestException):
+	# the host is failing, the call wasn't made
+	pass
+
+class HostLimiter:
+	"""
+	Concurrency limit and circuit breaker for one host. The limit grows by one call per
+	limit's worth of successes and halves on every failure (AIMD), between 1 and max_limit.
+	"""
+	def __init__(self, host: str, max_limit: int):
+		self.host = host
+		self.max_limit = max_limit
+		self.limit = float(max_limit)
+		self.in_flight = 0
+		self.failures = 0
+		# time.monotonic() when the circuit opened, None while it's closed
+		self.opened_at: float | None = None
+		self._trial = False
+		self._cond = threading.Condition()
+
+	def _check_circuit(self):
+		if self.opened_at is None:
+			return
+		if self._trial or time.monotonic() - self.opened_at < BREAKER_SECONDS:
+			raise CircuitOpenError(f"{self.host} is failing, skipping calls to it for now")
+		# half open, this call decides whether the circuit closes again
+		self._trial = True
+
+	def acquire(self) -> bool:
+		"""
+		Waits for a slot, every acquire must be followed by a release.
+
+		Returns:
+			bool: Whether this is the half-open trial call, pass it on to release.
+		"""
+		with self._cond:
+			self._check_circuit()
+			while self.in_flight >= int(self.limit):
+				self._cond.wait()
+				self._check_circuit()
+			self.in_flight += 1
+			# _check_circuit only sets it while the circuit is open
+			return self.opened_at is not None
+
+	def release(self, ok: bool, trial: bool = False):
+		with self._cond:
+			self.in_flight -= 1
+			if ok:
+				self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+			else:
+				self.limit = max(1.0, self.limit / 2)
+			# calls that started before the circuit opened don't get a say in closing it
+			if trial or self.opened_at is None:
+				if ok:
+					self.failures = 0
+					if self.opened_at is not None:
+						print(f"{self.host} is answering again, closing its circuit")
+					self.opened_at = None
+				else:
+					self.failures += 1
+					if trial or self.failures >= BREAKER_FAILURES:
+						print(f"WARNING: {self.failures} failed calls in a row to {self.host}, skipping it for {BREAKER_SECONDS:.0f}s")
+						self.opened_at = time.monotonic()
+			if trial:
+				self._trial = False
+			self._cond.notify_all()
+
+	def __str__(self) -> str:
+		state = "closed" if self.opened_at is None else "open"
+		return f"{self.host}: limit {self.limit:.1f}/{self.max_limit}, circuit {state}"
+
+class CacheEntry:
+	def __init__(self, etag: str | None, last_modified: str | None, body_hash: str, body: str):
+		self.etag = etag
+		self.last_modified = last_modified
+		self.body_hash = body_hash
+		self.body = body
+
+class HttpCache:
+	"""
+	Persistent store of response bodies and their validators (ETag/Last-Modified), used
+	to make conditional requests. Least recently used entries are evicted once the
+	stored bodies exceed max_bytes.
+	"""
+	def __init__(self, path: str, max_bytes: int):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._db.execute(
+			"CREATE TABLE IF NOT EXISTS responses ("
+			"url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body_hash TEXT NOT NULL, "
+			"body TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+		)
+		self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+	def lookup(self, url: str) -> CacheEntry | None:
+		with self._lock:
+			row = self._db.execute("SELECT etag, last_modified, body_hash, body FROM responses WHERE url = ?", (url,)).fetchone()
+		return CacheEntry(*row) if row else None
+
+	def touch(self, url: str):
+		with self._lock:
+			self._db.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url))
+
+	def store(self, url: str, etag: str | None, last_modified: str | None, body_hash: str, body: str):
+		size = len(body.encode())
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			old = self._db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+			self._db.execute(
+				"INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(url, etag, last_modified, body_hash, body, size, time.time())
+			)
+			self._size += size - (old[0] if old else 0)
+			while self._size > self.max_bytes:
+				oldest, evicted = self._db.execute("SELECT url, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+				self._db.execute("DELETE FROM responses WHERE url = ?", (oldest,))
+				self._size -= evicted
+				self.evictions += 1
+
+	def stats(self) -> str:
+		return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions, {self._size / 1024:.0f}KiB stored"
+
+class CachedResponse:
+	def __init__(self, url: str, status_code: int, text: str, body_hash: str | None, changed: bool):
+		self.url = url
+		self.status_code = status_code
+		self.text = text
+		self.body_hash = body_hash
+		# False when the body is the same as the last time this url was fetched
+		self.changed = changed
+
+	def raise_for_status(self):
+		if self.status_code >= 400:
+			raise requests.HTTPError(f"{self.status_code} error for url: {self.url}")
+
+class HttpClient:
+	def __init__(self, per_host_limit: int = PER_HOST_LIMIT):
+		self.per_host_limit = max(1, per_host_limit)
+		# one session for the whole process so keep-alive connections get reused between requests
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=8, pool_maxsize=self.per_host_limit)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+		self.timeouts = dict(HOST_TIMEOUTS)
+		self._limiters: dict[str, HostLimiter] = {}
+		self._limiters_lock = threading.Lock()
+		self.cache: HttpCache | None = None
+		if HTTP_CACHE_MB > 0:
+			self.cache = HttpCache(os.path.join(CACHE_DIR, 'http.sqlite3'), int(HTTP_CACHE_MB * 1024 * 1024))
+
+	def _limiter(self, host: str) -> HostLimiter:
+		with self._limiters_lock:
+			if host not in self._limiters:
+				self._limiters[host] = HostLimiter(host, self.per_host_limit)
+			return self._limiters[host]
+
+	def stats(self) -> str:
+		with self._limiters_lock:
+			return ", ".join(str(limiter) for limiter in self._limiters.values())
+
+	def _backoff(self, attempt: int, response: requests.Response | None) -> float:
+		retry_after = response.headers.get('Retry-After') if response is not None else None
+		if retry_after and retry_after.isdigit():
+			return min(BACKOFF_MAX, float(retry_after))
+		# full jitter, so throttled threads don't all come back at the same moment
+		return random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+
+	def request(self, method: str, url: str, **kwargs) -> requests.Response:
+		"""
+		Makes a request through the host's limiter, retrying failures up to RETRIES times.
+
+		Raises:
+			CircuitOpenError: The host has been failing, the request wasn't sent.
+		"""
+		host = urlsplit(url).netloc
+		limiter = self._limiter(host)
+		kwargs.setdefault('timeout', self.timeouts.get(host, TIMEOUT))
+		for attempt in range(RETRIES + 1):
+			trial = limiter.acquire()
+			response, ok = None, False
+			try:
+				response = self.session.request(method, url, **kwargs)
+				ok = response.status_code not in RETRY_STATUSES
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt == RETRIES:
+					raise
+			finally:
+				# any other exception is raised straight away, but still counts as a failure
+				limiter.release(ok, trial)
+			if response is not None and (ok or attempt == RETRIES):
+				return response
+			time.sleep(self._backoff(attempt, response))
+
+	def get(self, url: str, **kwargs) -> requests.Response:
+		return self.request('GET', url, **kwargs)
+
+	def get_cached(self, url: str) -> CachedResponse:
+		"""
+		GETs a url through the on-disk cache, sending a conditional request when a
+		previous response is stored. A 304 is answered from the cache.
+		"""
+		if not self.cache:
+			response = self.get(url)
+			return CachedResponse(url, response.status_code, response.text, None, True)
+		entry = self.cache.lookup(url)
+		headers = {}
+		if entry and entry.etag:
+			headers['If-None-Match'] = entry.etag
+		if entry and entry.last_modified:
+			headers['If-Modified-Since'] = entry.last_modified
+		response = self.get(url, headers=headers)
+		if response.status_code == 304 and entry:
+			self.cache.hits += 1
+			self.cache.touch(url)
+			return CachedResponse(url, 200, entry.body, entry.body_hash, False)
+		if response.status_code != 200:
+			self.cache.misses += 1
+			return CachedResponse(url, response.status_code, response.text, None, True)
+		body_hash = hashlib.sha256(response.content).hexdigest()
+		if entry and entry.body_hash == body_hash:
+			# the server doesn't support validators (or ignored them) but nothing changed
+			self.cache.hits += 1
+			self.cache.touch(url)
+			return CachedResponse(url, 200, entry.body, body_hash, False)
+		self.cache.misses += 1
+		self.cache.store(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), body_hash, response.text)
+		return CachedResponse(url, 200, response.text, body_hash, True)
+
+	def post(self, url: str, **kwargs) -> requests.Response:
+		return self.request('POST', url, **kwargs)
+
+	def map(self, fn, items: list) -> list:
+		"""
+		Calls fn on each item concurrently, bounded by the per-host limit.
+
+		Args:
+			fn: The function to call with each item.
+			items (list): The items to process.
+
+		Returns:
+			list: The results in the same order as items. If fn raised for an item,
+			the exception is returned in that item's place instead of being raised.
+		"""
+		def call(item):
+			try:
+				return fn(item)
+			except Exception as e:
+				return e
+
+		if not items:
+			return []
+		with ThreadPoolExecutor(max_workers=min(len(items), self.per_host_limit)) as pool:
+			return list(pool.map(call, items))
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import contextvars
+import metrics
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+
+# lower numbers go out first
+PRIORITY_EVENT = 0
+PRIORITY_MESSAGE = 1
+# calls allowed per route in a rolling window (calls, seconds), kept under discord's own buckets so we never see a 429
+ROUTE_LIMITS = {
+	'message': (5, 5.0),
+	'event': (5, 5.0),
+}
+# discord's limit on the length of a single message
+MESSAGE_LIMIT = 2000
+
+class Bucket:
+	def __init__(self, limit: int, per: float):
+		self.limit = limit
+		self.per = per
+		self._calls: deque[float] = deque()
+
+	def delay(self) -> float:
+		# seconds until another call may be made on this route
+		now = time.monotonic()
+		while self._calls and now - self._calls[0] >= self.per:
+			self._calls.popleft()
+		if len(self._calls) < self.limit:
+			return 0.0
+		return self.per - (now - self._calls[0])
+
+	def record(self):
+		self._calls.append(time.monotonic())
+
+def _digest_batches(messages: list[str]) -> list[list[int]]:
+	# indices of the messages that go into each digest chunk
+	batches = []
+	current, length = [], 0
+	for i, message in enumerate(messages):
+		if current and length + 1 + len(message) > MESSAGE_LIMIT:
+			batches.append(current)
+			current, length = [], 0
+		length += len(message) + (1 if current else 0)
+		current.append(i)
+	if current:
+		batches.append(current)
+	return batches
+
+def digest_chunks(messages: list[str]) -> list[str]:
+	# join messages into as few discord messages as fit under the length limit
+	return ["\n".join(messages[i] for i in batch) for batch in _digest_batches(messages)]
+
+class Outbox:
+	"""
+	Queue for outbound discord calls. Calls go out in priority order, each route is held
+	under its rate limit, and channel messages sent inside a window() are merged into one
+	digest per channel.
+	"""
+	def __init__(self, concurrency: int = 4):
+		self.concurrency = concurrency
+		self._queue: asyncio.PriorityQueue = None
+		self._slots: asyncio.Semaphore = None
+		self._worker: asyncio.Task = None
+		self._order = itertools.count()
+		self._buckets: dict[str, Bucket] = {}
+		self._deferred = 0
+		self._digest: dict | None = None
+		self._windows = 0
+		self.sent = 0
+		self.failed = 0
+		self.latency_last = 0.0
+		self.latency_max = 0.0
+		self._latency_total = 0.0
+
+	@property
+	def depth(self) -> int:
+		# calls waiting to go out, including ones held back by a rate limit
+		return (self._queue.qsize() if self._queue else 0) + self._deferred
+
+	def stats(self) -> str:
+		done = self.sent + self.failed
+		average = self._latency_total / done if done else 0.0
+		return f"{self.sent} sent, {self.failed} failed, {self.depth} queued, send latency {average * 1000:.0f}ms avg / {self.latency_max * 1000:.0f}ms max"
+
+	def _bucket(self, route: str) -> Bucket:
+		if route not in self._buckets:
+			limit, per = ROUTE_LIMITS[route.split(':', 1)[0]]
+			self._buckets[route] = Bucket(limit, per)
+		return self._buckets[route]
+
+	async def submit(self, route: str, priority: int, call, stage: str = 'discord_call'):
+		"""
+		Queues a discord call and waits for it to go out.
+
+		Args:
+			route (str): '<kind>:<id>', where kind is a key of ROUTE_LIMITS.
+			priority (int): PRIORITY_EVENT or PRIORITY_MESSAGE.
+			call: A function returning the coroutine to await.
+			stage (str): What the call is timed as, see metrics.span.
+
+		Returns:
+			The result of the call, exceptions are raised to the caller.
+		"""
+		if not self._worker:
+			self._queue = asyncio.PriorityQueue()
+			self._slots = asyncio.Semaphore(self.concurrency)
+			self._worker = asyncio.get_running_loop().create_task(self._work())
+		future = asyncio.get_running_loop().create_future()
+		# the worker task was started from whichever caller came first, each call runs in its own caller's context (group included)
+		context = contextvars.copy_context()
+		await self._queue.put((priority, next(self._order), time.monotonic(), route, call, stage, future, context))
+		return await future
+
+	async def send_message(self, channel, message: str):
+		return await self.submit(f"message:{channel.id}", PRIORITY_MESSAGE, lambda: channel.send(message), 'discord_send')
+
+	def buffer(self, channel, message: str, on_failure=None) -> bool:
+		# hold the message for the digest if a window is open, on_failure() is awaited if its chunk can't be sent
+		if self._digest is None:
+			return False
+		self._digest.setdefault(channel, []).append((message, on_failure))
+		return True
+
+	@asynccontextmanager
+	async def window(self):
+		"""
+		Messages sent while any window is open are merged per channel and sent when the last one closes.
+		"""
+		if self._digest is None:
+			self._digest = {}
+		self._windows += 1
+		try:
+			yield
+		finally:
+			self._windows -= 1
+			if self._windows == 0:
+				digest, self._digest = self._digest, None
+				sends, batches = [], []
+				for channel, entries in digest.items():
+					for batch in _digest_batches([message for message, _ in entries]):
+						sends.append(self.send_message(channel, "\n".join(entries[i][0] for i in batch)))
+						batches.append([entries[i][1] for i in batch])
+				for result, callbacks in zip(await asyncio.gather(*sends, return_exceptions=True), batches):
+					if isinstance(result, Exception):
+						print(f"ERROR: failed to send digest message: {result!r}")
+						for on_failure in callbacks:
+							if on_failure:
+								await on_failure()
+
+	def _requeue(self, item):
+		self._deferred -= 1
+		self._queue.put_nowait(item)
+
+	async def _work(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			item = await self._queue.get()
+			bucket = self._bucket(item[3])
+			delay = bucket.delay()
+			if delay > 0:
+				# let other routes go ahead while this one cools down
+				self._deferred += 1
+				loop.call_later(delay, self._requeue, item)
+				continue
+			bucket.record()
+			await self._slots.acquire()
+			loop.create_task(self._run(item), context=item[7])
+
+	async def _run(self, item):
+		_, _, queued_at, route, call, stage, future, _ = item
+		try:
+			with metrics.span(stage):
+				result = await call()
+			self.sent += 1
+			if not future.done():
+				future.set_result(result)
+		except Exception as e:
+			self.failed += 1
+			if not future.done():
+				future.set_exception(e)
+		finally:
+			self._slots.release()
+		self.latency_last = time.monotonic() - queued_at
+		self.latency_max = max(self.latency_max, self.latency_last)
+		self._latency_total += self.latency_last
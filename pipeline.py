@@ -0,0 +1,224 @@
+from shared import shared
+import events
+import reconcile
+import reminders
+import net
+
+import os
+import time
+import asyncio
+from traceback import format_exc as get_stacktrace
+
+# how many events wait between two stages of a sync, a full queue holds the stage before it back
+QUEUE_SIZE = int(os.getenv('RALLY_PIPELINE_QUEUE', '16'))
+# feed items looked up in the store with a single BatchGetItem, RSS items are small so this many can wait
+LOOKUP_BATCH = 100
+# events written with a single BatchWriteItem
+PERSIST_BATCH = 25
+# seconds the categorize and persist stages wait for a batch to fill, a lone event is held back at most this long by each
+LINGER = 0.05
+
+# sent down a queue once the stage feeding it has nothing more
+_DONE = object()
+
+class Item:
+	"""
+	One feed item on its way through a sync.
+	"""
+	__slots__ = ('rss_item', 'guid', 'fingerprint', 'stored', 'event', 'text', 'saved')
+
+	def __init__(self, rss_item: dict, guid: int | None, fingerprint: str):
+		self.rss_item = rss_item
+		self.guid = guid
+		self.fingerprint = fingerprint
+		# the lookup batch the item was in, see EventStore.batch_get
+		self.stored: dict = None
+		self.event: events.MeetupEvent = None
+		# what to categorize the event by, None once it has a category
+		self.text: str | None = None
+		self.saved = False
+
+async def _take(queue: asyncio.Queue, limit: int, linger: float = 0.0) -> tuple[list, bool]:
+	"""
+	Waits for an item and takes whatever else is already queued, up to limit, so a busy stage
+	works in full batches while a trickle of items goes through one at a time. With linger,
+	an empty queue is waited on that many seconds longer before a partial batch is returned.
+
+	Returns:
+		tuple[list, bool]: The items, and whether the stage before has finished.
+	"""
+	items = []
+	item = await queue.get()
+	deadline = asyncio.get_running_loop().time() + linger
+	while item is not _DONE:
+		items.append(item)
+		if len(items) >= limit:
+			return items, False
+		if not queue.empty():
+			item = queue.get_nowait()
+			continue
+		remaining = deadline - asyncio.get_running_loop().time()
+		if remaining <= 0:
+			return items, False
+		try:
+			item = await asyncio.wait_for(queue.get(), remaining)
+		except asyncio.TimeoutError:
+			return items, False
+	# for the stage's other workers, taking it freed the slot
+	queue.put_nowait(_DONE)
+	return items, True
+
+async def _stage(name: str, inbox: asyncio.Queue, outbox: asyncio.Queue | None, workers: int, batch: int, work, linger: float = 0.0):
+	# runs `workers` copies of work(items) until the inbox is finished, then finishes the outbox
+	async def worker():
+		done = False
+		while not done:
+			items, done = await _take(inbox, batch, linger)
+			if not items:
+				continue
+			try:
+				await work(items)
+			except Exception:
+				print(f"Exception occured in the {name} stage of a sync:\n{get_stacktrace()}")
+	await asyncio.gather(*(worker() for _ in range(workers)))
+	if outbox is not None:
+		await outbox.put(_DONE)
+
+class Sync:
+	"""
+	A sync of the current group. Feed items are parsed one at a time and pass through
+	bounded stages: store lookup, detail fetch, categorize, persist and discord. A stage
+	waits whenever the next one's queue is full, so the first discord update goes out
+	while the rest of the feed is still being read and the number of events in memory
+	doesn't grow with the feed.
+	"""
+	def __init__(self):
+		self.now = events.now_ms()
+		self.lookup_queue = asyncio.Queue(LOOKUP_BATCH)
+		self.fetch_queue = asyncio.Queue(QUEUE_SIZE)
+		self.categorize_queue = asyncio.Queue(QUEUE_SIZE)
+		self.persist_queue = asyncio.Queue(QUEUE_SIZE)
+		self.discord_queue = asyncio.Queue(QUEUE_SIZE)
+		self.discord_events: dict = None
+		self.slots = asyncio.Semaphore(reconcile.DISCORD_CONCURRENCY)
+		# guids of every event that made it through, plus those deferred, anything else upcoming is rechecked
+		self.seen: set[int] = set()
+		self.deferred: set[int] = set()
+		self.items = 0
+		self.fetched = 0
+		self.actions = 0
+		self.first_update: float | None = None
+
+	async def _feed(self, text: str):
+		try:
+			for rss_item in events.iter_rss_items(text):
+				self.items += 1
+				await self.lookup_queue.put(Item(rss_item, events.rss_guid(rss_item), events.rss_fingerprint(rss_item)))
+		finally:
+			await self.lookup_queue.put(_DONE)
+
+	async def _lookup(self, items: list[Item]):
+		stored = await shared.run_blocking(shared.store.batch_get, [item.guid for item in items if item.guid is not None])
+		for item in items:
+			event = stored.get(item.guid)
+			if events.needs_detail(event, item.guid, item.fingerprint, self.now):
+				item.stored = stored
+				await self.fetch_queue.put(item)
+			else:
+				# unchanged since its page was last fetched, it only has to be checked against discord
+				item.event = event
+				await self.discord_queue.put(item)
+
+	async def _fetch(self, items: list[Item]):
+		for item in items:
+			self.fetched += 1
+			try:
+				result = await shared.run_blocking(events.fetch_event, item.rss_item, item.guid, item.fingerprint, item.stored, self.now)
+			except net.CircuitOpenError:
+				self.deferred.add(item.guid)
+				continue
+			except Exception:
+				print(f"Exception occured while processing {item.rss_item}:\n{get_stacktrace()}")
+				continue
+			finally:
+				item.stored = None
+			if result:
+				item.event, item.text = result
+				await self.categorize_queue.put(item)
+
+	async def _categorize(self, items: list[Item]):
+		uncategorized = [(item.event, item.text) for item in items if item.text]
+		if uncategorized:
+			await shared.run_blocking(events.categorize_events, uncategorized)
+		for item in items:
+			await self.persist_queue.put(item)
+
+	async def _persist(self, items: list[Item]):
+		# new events are saved along with their snowflake once their discord event exists, see reconcile.apply_discord
+		to_save = [item for item in items if item.event.snowflake_id and item.event.changed_attributes()]
+		if to_save:
+			try:
+				await shared.run_blocking(events.write_events, [item.event for item in to_save], [])
+				for item in to_save:
+					item.saved = True
+			except Exception:
+				print(f"Exception occured while writing {len(to_save)} events:\n{get_stacktrace()}")
+		for item in items:
+			await self.discord_queue.put(item)
+
+	async def _reconcile(self, items: list[Item]):
+		for item in items:
+			event = item.event
+			self.seen.add(int(event.sort))
+			if not await reconcile.fetch_discord_event(event, self.discord_events):
+				continue
+			actions = reconcile.plan_event(event, self.discord_events.get(int(event.snowflake_id)) if event.snowflake_id else None)
+			if item.saved and not actions:
+				actions = [reconcile.SaveEvent(event)]
+			for action in actions:
+				if isinstance(action, (reconcile.CreateEvent, reconcile.UpdateEvent)):
+					await reconcile.apply_discord(action, self.slots)
+					if self.first_update is None:
+						self.first_update = time.perf_counter() - self.started
+				elif isinstance(action, reconcile.SaveEvent):
+					action.succeeded = item.saved
+				elif isinstance(action, reconcile.Notify) and action.after.succeeded:
+					await shared.message_channel(action.channel, action.message, action.dedup_seconds)
+					action.succeeded = True
+				reminders.track(action)
+			self.actions += len(actions)
+
+	async def run(self) -> int:
+		self.started = time.perf_counter()
+		self.discord_events, response = await asyncio.gather(reconcile.fetch_discord_events(), shared.run_blocking(events.fetch_rss))
+		async with reconcile.digest():
+			results = await asyncio.gather(
+				self._feed(response.text),
+				_stage('lookup', self.lookup_queue, self.fetch_queue, 1, LOOKUP_BATCH, self._lookup),
+				_stage('detail fetch', self.fetch_queue, self.categorize_queue, shared.http.per_host_limit, 1, self._fetch),
+				_stage('categorize', self.categorize_queue, self.persist_queue, 1, events.AI_BATCH_SIZE, self._categorize, LINGER),
+				_stage('persist', self.persist_queue, self.discord_queue, 1, PERSIST_BATCH, self._persist, LINGER),
+				_stage('discord', self.discord_queue, None, reconcile.DISCORD_CONCURRENCY, 1, self._reconcile),
+				return_exceptions=True)
+			for result in results:
+				# the feed couldn't be read to the end, so events missing from it can't be told apart from cancelled ones
+				if isinstance(result, Exception):
+					raise result
+			first = f"{self.first_update:.2f}s" if self.first_update is not None else "never"
+			print(f"Streamed {self.items} feed items, fetched {self.fetched} event pages, first discord update after {first}")
+			if self.deferred:
+				print(f"Deferred {len(self.deferred)} events to the next run, meetup is failing")
+			still_active, gone = await reconcile.check_stale(self.seen | self.deferred)
+			tail = [reconcile.SaveEvent(event) for event in still_active] + [reconcile.DeleteEvent(event) for event in gone]
+			await reconcile.apply(tail)
+		reminders.sync(tail)
+		return self.actions + len(tail)
+
+async def sync() -> int:
+	"""
+	Brings Discord and DynamoDB in line with the current group's Meetup feed, see Sync.
+
+	Returns:
+		int: How many actions were applied.
+	"""
+	return await Sync().run()
@@ -0,0 +1,263 @@
+from shared import shared
+import groups
+import events
+import outbox
+import metrics
+
+import os
+import asyncio
+import discord
+import datetime
+from traceback import format_exc as get_stacktrace
+
+# how many discord event edits/creations are in flight at once while syncing
+DISCORD_CONCURRENCY = int(os.getenv('RALLY_DISCORD_CONCURRENCY', '4'))
+# an event can change again the same day, so "has been updated" is only held back this long (see shared.message_channel)
+UPDATE_DEDUP_SECONDS = 3600
+
+def get_channel_for_ddb_event(event: events.MeetupEvent):
+	if not event:
+		return 'events-general'
+	category = event.category
+	if category not in events.categories:
+		category = 'other'
+	if category == 'other':
+		category = 'events-general'
+	return category
+
+def mention_for(event: events.MeetupEvent) -> str:
+	group = groups.of(event)
+	return group.online_mention if event.online else group.in_person_mention
+
+class Snapshot:
+	"""
+	Everything a reconcile needs to know about Meetup, DynamoDB and Discord, see take_snapshot.
+	"""
+	def __init__(self, meetup_events: list[events.MeetupEvent], discord_events: dict[int, discord.ScheduledEvent],
+			unreachable: set[int], still_active: list[events.MeetupEvent], gone: list[events.MeetupEvent], unreadable: set[int] | None = None):
+		self.meetup_events = meetup_events
+		self.discord_events = discord_events
+		# events whose discord event couldn't be fetched for a reason other than it not existing
+		self.unreachable = unreachable
+		# upcoming events that dropped out of the RSS feed, split by what their event page says now
+		self.still_active = still_active
+		self.gone = gone
+		# events whose stored row couldn't be read, they're rebuilt from their event page
+		self.unreadable = unreadable or set()
+
+class Action:
+	def __init__(self, event: events.MeetupEvent):
+		self.event = event
+		self.succeeded = False
+
+class CreateEvent(Action):
+	def __str__(self) -> str:
+		return f"create discord event for {self.event.sort} | {self.event.title}"
+
+class UpdateEvent(Action):
+	def __init__(self, event: events.MeetupEvent, discord_event: discord.ScheduledEvent, updates: dict):
+		super().__init__(event)
+		self.discord_event = discord_event
+		self.updates = updates
+
+	def __str__(self) -> str:
+		changes = ", ".join(f"{field}: {getattr(self.discord_event, field, None)!r} -> {value!r}" for field, value in self.updates.items())
+		return f"update discord event {self.discord_event.id} for {self.event.sort} | {self.event.title} ({changes})"
+
+class SaveEvent(Action):
+	def __str__(self) -> str:
+		return f"save {self.event.sort} | {self.event.title} ({', '.join(self.event.changed_attributes())})"
+
+class DeleteEvent(Action):
+	def __str__(self) -> str:
+		return f"delete {self.event.sort} | {self.event.title} and discord event {self.event.snowflake_id}"
+
+class DeleteUnreadable(Action):
+	def __str__(self) -> str:
+		return f"delete the unreadable row of {self.event.sort} | {self.event.title}, it's rebuilt from the event page"
+
+class Notify(Action):
+	def __init__(self, event: events.MeetupEvent, channel: str, message: str, after: Action | None = None, dedup_seconds: float | None = None):
+		super().__init__(event)
+		self.channel = channel
+		self.message = message
+		# only sent if this action went through
+		self.after = after
+		self.dedup_seconds = dedup_seconds
+
+	def __str__(self) -> str:
+		return f"message #{self.channel}: {self.message}"
+
+def diff_discord_event(event: events.MeetupEvent, discord_event: discord.ScheduledEvent) -> dict:
+	updates = {}
+	if discord_event.name != event.title:
+		updates['name'] = event.title
+	if discord_event.description != event.description:
+		updates['description'] = event.description
+	if discord_event.start_time != event.start_time:
+		updates['start_time'] = event.start_time
+	# use the explicit endtime if it exists and is set, otherwise its implicitly an hour long
+	if hasattr(event, 'endtime') and event.endtime and discord_event.end_time != event.endtime:
+		updates['end_time'] = event.endtime
+		if discord_event.start_time > updates['end_time']:
+			# the new end time is before the old start time, so the start has to move in the same edit
+			updates['start_time'] = event.start_time
+	if discord_event.location != event.location:
+		updates['location'] = event.location
+	return updates
+
+def plan_event(event: events.MeetupEvent, discord_event: discord.ScheduledEvent | None) -> list[Action]:
+	# what has to change for one event in the feed, discord_event is None if it has none (any more)
+	if not discord_event:
+		create = CreateEvent(event)
+		return [create, Notify(event, get_channel_for_ddb_event(event),
+			f"{mention_for(event)} {event.title} has been scheduled for <t:{round(event.start_time.timestamp())}>.", after=create)]
+	updates = diff_discord_event(event, discord_event)
+	if updates:
+		update = UpdateEvent(event, discord_event, updates)
+		return [update, Notify(event, get_channel_for_ddb_event(event), f"{mention_for(event)} {event.title} has been updated.",
+			after=update, dedup_seconds=UPDATE_DEDUP_SECONDS)]
+	if event.changed_attributes():
+		return [SaveEvent(event)]
+	return []
+
+def plan(snapshot: Snapshot) -> list[Action]:
+	"""
+	Works out what has to change to bring Discord and DynamoDB in line with Meetup. This
+	doesn't talk to anything, so it's cheap to run as often as we like.
+
+	Args:
+		snapshot (Snapshot): The current state of Meetup, DynamoDB and Discord.
+
+	Returns:
+		list[Action]: The actions to apply, in order.
+	"""
+	actions: list[Action] = []
+	for event in snapshot.meetup_events:
+		if event.sort in snapshot.unreachable:
+			continue
+		if int(event.sort) in snapshot.unreadable:
+			actions.append(DeleteUnreadable(event))
+		actions.extend(plan_event(event, snapshot.discord_events.get(int(event.snowflake_id)) if event.snowflake_id else None))
+	actions.extend(SaveEvent(event) for event in snapshot.still_active)
+	actions.extend(DeleteEvent(event) for event in snapshot.gone)
+	return actions
+
+async def fetch_discord_events() -> dict[int, discord.ScheduledEvent]:
+	# one request for every scheduled event in the guild, individual fetches are only needed for misses
+	with metrics.span('discord_fetch'):
+		return {de.id: de for de in await shared.guild.fetch_scheduled_events()}
+
+def digest():
+	# every announcement for a channel sent inside it goes out as one digest, see outbox.Outbox.window
+	return shared.outbox.window()
+
+async def fetch_discord_event(event: events.MeetupEvent, discord_events: dict[int, discord.ScheduledEvent]) -> bool:
+	"""
+	Fetches an event's discord event on its own if the bulk fetch missed it, adding it to
+	discord_events when it still exists.
+
+	Returns:
+		bool: False if it couldn't be fetched for a reason other than it not existing.
+	"""
+	if not event.snowflake_id or int(event.snowflake_id) in discord_events:
+		return True
+	try:
+		with metrics.span('discord_fetch'):
+			discord_event = await shared.guild.fetch_scheduled_event(event.snowflake_id)
+		discord_events[discord_event.id] = discord_event
+	except discord.errors.NotFound:
+		print(f"Invalid snowflake value for {event.title}, this has likely been deleted from discord, recreating...")
+	except Exception:
+		print(f"Exception occured while processing {event.title} ({event.id} | {event.snowflake_id}):\n{get_stacktrace()}")
+		return False
+	return True
+
+async def take_snapshot() -> Snapshot:
+	deferred: set[int] = set()
+	unreadable: set[int] = set()
+	meetup_events = await shared.run_blocking(events.fetch_meetup_events, deferred=deferred, unreadable=unreadable)
+	discord_events = await fetch_discord_events()
+	unreachable = set()
+	fallback_fetches = 0
+	for event in meetup_events:
+		if not event.snowflake_id or int(event.snowflake_id) in discord_events:
+			continue
+		fallback_fetches += 1
+		if not await fetch_discord_event(event, discord_events):
+			unreachable.add(event.sort)
+	print(f"Loaded {len(meetup_events)} meetup events with {fallback_fetches} individual discord event fetches")
+	# deferred events are still in the feed, they just couldn't be fetched this time
+	still_active, gone = await check_stale(set(map(lambda event: event.sort, meetup_events)) | deferred, save=False)
+	return Snapshot(meetup_events, discord_events, unreachable, still_active, gone, unreadable)
+
+async def check_stale(hashed_ids: set[int], save: bool = True) -> tuple[list[events.MeetupEvent], list[events.MeetupEvent]]:
+	# check for cancelled events: upcoming events that aren't in the feed, see events.recheck_stale_events
+	upcoming = await shared.run_blocking(events.query_upcoming_events, ['id', 'sort', 'title', 'timestamp'])
+	stale = [event for event in upcoming if event.sort not in hashed_ids]
+	if not stale:
+		return [], []
+	print(f"rechecking events {', '.join(f'{event.sort} | {event.title}' for event in stale)} ...")
+	return await shared.run_blocking(events.recheck_stale_events, stale, save)
+
+def print_plan(actions: list[Action]):
+	if not actions:
+		print("DRY RUN: nothing to do")
+	for action in actions:
+		print(f"DRY RUN: {action}")
+
+async def apply_discord(action: Action, slots: asyncio.Semaphore):
+	event = action.event
+	# bound now, the call itself runs later on the outbox
+	guild = shared.guild
+	async with slots:
+		try:
+			if isinstance(action, UpdateEvent):
+				discord_event, updates = action.discord_event, action.updates
+				await shared.outbox.submit(f"event:{guild.id}", outbox.PRIORITY_EVENT, lambda: discord_event.edit(**updates), 'discord_edit')
+				print(f"Updated discord event {event.sort} | {event.title}")
+			else:
+				discord_event = await shared.outbox.submit(f"event:{guild.id}", outbox.PRIORITY_EVENT, lambda: guild.create_scheduled_event(
+					name=event.title,
+					description=event.description,
+					start_time=event.start_time,
+					end_time=event.endtime if hasattr(event, 'endtime') and event.endtime else (event.start_time + datetime.timedelta(hours=1)),
+					location=event.location,
+					entity_type=discord.EntityType.external,
+					privacy_level=discord.PrivacyLevel.guild_only
+				), 'discord_create')
+				event.snowflake_id = discord_event.id
+				# saved straight away rather than in the batch, losing the snowflake would mean a duplicate event next run
+				await shared.run_blocking(shared.store.update, event)
+				print(f"Created new event w/ snowflake id: {event.snowflake_id}")
+			action.succeeded = True
+		except Exception:
+			print(f"Exception occured while applying '{action}':\n{get_stacktrace()}")
+
+async def apply(actions: list[Action]):
+	"""
+	Applies a plan: unreadable rows are deleted first, then discord edits and creations
+	(DISCORD_CONCURRENCY at a time), then the remaining DynamoDB writes in one batch, then
+	the announcements for whatever went through.
+	"""
+	for action in actions:
+		if isinstance(action, DeleteUnreadable):
+			await shared.run_blocking(shared.ddb.delete_raw, 'event', action.event.sort)
+			action.succeeded = True
+	slots = asyncio.Semaphore(DISCORD_CONCURRENCY)
+	await asyncio.gather(*(apply_discord(action, slots) for action in actions if isinstance(action, (CreateEvent, UpdateEvent))))
+	to_save = [action.event for action in actions if (isinstance(action, SaveEvent) or (isinstance(action, UpdateEvent) and action.succeeded)) and action.event.changed_attributes()]
+	to_delete = [action.event for action in actions if isinstance(action, DeleteEvent)]
+	if to_save or to_delete:
+		try:
+			await shared.run_blocking(events.write_events, to_save, to_delete)
+			for action in actions:
+				if isinstance(action, (SaveEvent, DeleteEvent)):
+					action.succeeded = True
+		except Exception:
+			print(f"Exception occured while writing {len(to_save)} events and deleting {len(to_delete)}:\n{get_stacktrace()}")
+	async with digest():
+		for action in actions:
+			if isinstance(action, Notify) and (action.after is None or action.after.succeeded):
+				await shared.message_channel(action.channel, action.message, action.dedup_seconds)
+				action.succeeded = True
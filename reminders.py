@@ -0,0 +1,119 @@
+from shared import shared
+import groups
+import events
+import reconcile
+import local_snapshot
+
+import discord
+import datetime
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.jobstores.base import JobLookupError
+
+# in-person events are announced the day before, online events shortly before they start
+IN_PERSON_LEAD = datetime.timedelta(hours=24)
+ONLINE_LEAD = datetime.timedelta(hours=1)
+# after a restart, reminders missed by less than this are still sent
+CATCH_UP = datetime.timedelta(hours=1)
+REMINDER_ATTRIBUTES = ['id', 'sort', 'title', 'timestamp', 'online', 'category', 'snowflake_id', 'meetup_group']
+
+def _job_id(snowflake_id) -> str:
+	return f"reminder-{int(snowflake_id)}"
+
+def reminder_for(event: events.MeetupEvent) -> tuple[datetime.datetime, str, str] | None:
+	start = event.start_time
+	if start is None:
+		return None
+	channel = reconcile.get_channel_for_ddb_event(event)
+	if event.online:
+		return start - ONLINE_LEAD, channel, f"{reconcile.mention_for(event)} {event.title} starts soon! (<t:{round(start.timestamp())}:t>)"
+	return start - IN_PERSON_LEAD, channel, f"{reconcile.mention_for(event)} {event.title} is tomorrow! (<t:{round(start.timestamp())}>)"
+
+def schedule(event: events.MeetupEvent, catch_up: bool = False) -> bool:
+	"""
+	Registers (or moves) the one-shot job that sends an event's reminder.
+
+	Args:
+		event (events.MeetupEvent): The event, it needs a snowflake_id and a start time.
+		catch_up (bool): Send the reminder right away if its time passed less than CATCH_UP ago.
+
+	Returns:
+		bool: Whether a reminder is scheduled.
+	"""
+	if not event.snowflake_id:
+		return False
+	reminder = reminder_for(event)
+	now = datetime.datetime.now(shared.est)
+	if not reminder or event.start_time <= now:
+		cancel(event.snowflake_id)
+		return False
+	when, channel, message = reminder
+	if when <= now:
+		if not catch_up or now - when > CATCH_UP:
+			cancel(event.snowflake_id)
+			return False
+		when = now
+	shared.scheduler.add_job(send, DateTrigger(run_date=when), args=[groups.of(event).meetup_group, channel, message],
+		id=_job_id(event.snowflake_id), replace_existing=True, misfire_grace_time=int(CATCH_UP.total_seconds()))
+	return True
+
+async def send(meetup_group: str, channel: str, message: str):
+	# jobs run outside of any group's context, so the reminder says which guild it goes to
+	with groups.use(groups.named(meetup_group)):
+		await shared.message_channel(channel, message)
+
+def cancel(snowflake_id):
+	try:
+		shared.scheduler.remove_job(_job_id(snowflake_id))
+	except JobLookupError:
+		pass
+
+def track(action: reconcile.Action):
+	# keep the event's reminder job (and the local snapshot) in line with what an applied action created, moved or deleted
+	if isinstance(action, reconcile.DeleteEvent) and action.event.snowflake_id:
+		cancel(action.event.snowflake_id)
+		local_snapshot.remove(action.event.snowflake_id)
+	elif isinstance(action, (reconcile.CreateEvent, reconcile.UpdateEvent, reconcile.SaveEvent)) and action.succeeded:
+		schedule(action.event)
+		local_snapshot.upsert(action.event)
+
+def sync(actions: list[reconcile.Action]):
+	for action in actions:
+		track(action)
+	local_snapshot.save()
+
+async def restore(discord_events: list):
+	"""
+	Schedules reminders for every upcoming event of the current group whose discord event is
+	still scheduled, used at startup. Reminders of events deleted or cancelled in discord while
+	the bot was offline (e.g. ones restored from the local snapshot) are cancelled.
+
+	Args:
+		discord_events (list): The guild's scheduled events, fetched just before.
+	"""
+	live = {de.id for de in discord_events if de.status == discord.EventStatus.scheduled}
+	upcoming = await shared.run_blocking(events.query_upcoming_events, REMINDER_ATTRIBUTES)
+	upcoming = [event for event in upcoming if event.snowflake_id and int(event.snowflake_id) in live]
+	scheduled = sum(schedule(event, catch_up=True) for event in upcoming)
+	meetup_group = groups.current().meetup_group
+	for job in shared.scheduler.get_jobs():
+		if job.id.startswith("reminder-") and job.args[0] == meetup_group and int(job.id.split("-", 1)[1]) not in live:
+			job.remove()
+	print(f"Scheduled reminders for {scheduled} upcoming events still scheduled in discord")
+	await shared.run_blocking(local_snapshot.replace, upcoming, groups.current())
+
+def cancel_group(meetup_group: str):
+	# another replica looks after the group now
+	for job in shared.scheduler.get_jobs():
+		if job.id.startswith("reminder-") and job.args[0] == meetup_group:
+			job.remove()
+
+def restore_from_snapshot(owned: set[str]):
+	"""
+	Schedules reminders from the local snapshot file, so they work before DynamoDB has been read.
+
+	Args:
+		owned (set[str]): Only events of these groups get a reminder.
+	"""
+	rows = [row for row in local_snapshot.load() if groups.named(row.get('meetup_group')).meetup_group in owned]
+	scheduled = sum(schedule(events.MeetupEvent(**row), catch_up=True) for row in rows)
+	print(f"Scheduled reminders for {scheduled} events from the local snapshot")
@@ -1,32 +1,118 @@
 import os
-import aws
+import groups
+import outbox
+import metrics
 import discord
+import time
 import asyncio
-from collections import deque
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from zoneinfo import ZoneInfo
 
+# upper bound on blocking calls (HTTP, DynamoDB, AI) running off the event loop at once
+BLOCKING_WORKERS = int(os.getenv('RALLY_BLOCKING_WORKERS', '8'))
+# local state (HTTP cache, event snapshot etc.) lives here so it survives restarts
+CACHE_DIR = os.getenv('RALLY_CACHE_DIR', os.path.expanduser('~/.cache/rallybot'))
+
+class LoopLagMonitor:
+	"""
+	Measures how late the event loop wakes up from a fixed sleep, which is how long
+	something blocked it. `last` and `max` are in seconds.
+	"""
+	def __init__(self, interval: float = 0.25, warn_after: float = 0.1):
+		self.interval = interval
+		self.warn_after = warn_after
+		self.last = 0.0
+		self.max = 0.0
+		self._task: asyncio.Task = None
+
+	def start(self, loop: asyncio.AbstractEventLoop):
+		if not self._task:
+			self._task = loop.create_task(self._run())
+
+	def take_max(self) -> float:
+		# return the worst lag seen since the last call and start measuring again
+		worst, self.max = self.max, 0.0
+		return worst
+
+	async def _run(self):
+		while True:
+			before = time.perf_counter()
+			await asyncio.sleep(self.interval)
+			self.last = max(0.0, time.perf_counter() - before - self.interval)
+			self.max = max(self.max, self.last)
+			if self.last > self.warn_after:
+				print(f"WARNING: event loop was blocked for {self.last * 1000:.0f}ms")
+
 class Singleton:
 	client: discord.Client = None
-	guild: discord.Guild = None
 	est = ZoneInfo('America/Chicago')
-	_channels: dict[str, discord.guild.TextChannel] = None
-	recent_messages = deque(maxlen=5)
 
 	def __init__(self):
-		self._ddb: aws.DynamoDBClient = None
+		# boto3 and requests are slow to import, so aws and net are only loaded on first use
+		self._ddb: 'aws.DynamoDBClient' = None
+		self._http: 'net.HttpClient' = None
+		self._store: 'storage.EventStore' = None
+		self._dedup: 'dedup.DedupIndex' = None
 		self._loop: asyncio.AbstractEventLoop = None
 		self._scheduler: AsyncIOScheduler = None
+		self._executor: ThreadPoolExecutor = None
+		self.loop_lag = LoopLagMonitor()
+		self.outbox = outbox.Outbox()
+		# a sync's discord workers may all want the channels at once, only one of them fetches them
+		self._channels_lock = asyncio.Lock()
 		self._quiet = not not os.getenv('QUIET_RALLY')
 		if self._quiet:
 			print("ALERT: running Rally in silent mode...")
 	
 	@property
-	def ddb(self) -> aws.DynamoDBClient:
+	def ddb(self) -> 'aws.DynamoDBClient':
 		if not self._ddb:
+			import aws
 			self._ddb = aws.DynamoDBClient()
 		return self._ddb
 	
+	@property
+	def http(self) -> 'net.HttpClient':
+		if not self._http:
+			import net
+			self._http = net.HttpClient()
+		return self._http
+	
+	@property
+	def guild(self) -> discord.Guild:
+		# the guild of the group being synced, see groups.use
+		return groups.current().guild
+
+	@guild.setter
+	def guild(self, guild: discord.Guild):
+		groups.current().guild = guild
+
+	@property
+	def store(self) -> 'storage.EventStore':
+		if not self._store:
+			import storage
+			self._store = storage.create_store()
+		return self._store
+	
+	@property
+	def dedup(self) -> 'dedup.DedupIndex':
+		# blocking on first use, see _claim_message
+		if not self._dedup:
+			import dedup
+			self._dedup = dedup.create_index()
+		return self._dedup
+
+	def _claim_message(self, channel_id: int, message: str, seconds: float | None) -> bool:
+		import dedup
+		return self.dedup.claim(dedup.message_key(channel_id, message), seconds)
+
+	def _release_message(self, channel_id: int, message: str):
+		import dedup
+		self.dedup.release(dedup.message_key(channel_id, message))
+
 	@property
 	def loop(self):
 		if not self._loop:
@@ -39,34 +125,65 @@ class Singleton:
 			self._scheduler = AsyncIOScheduler(gconfig={'event_loop': self.loop})
 		return self._scheduler
 	
-	async def message_channel(self, channel_name: str, message: str):
+	@property
+	def executor(self) -> ThreadPoolExecutor:
+		if not self._executor:
+			self._executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="rally-io")
+		return self._executor
+	
+	async def run_blocking(self, fn, *args, **kwargs):
+		"""
+		Runs a blocking call (requests, boto3, PynamoDB) on the bounded I/O executor so
+		it doesn't stall the discord.py event loop.
+		"""
+		# the executor doesn't carry context variables over by itself, the current group is one of them
+		context = contextvars.copy_context()
+		return await self.loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, **kwargs))
+
+	async def message_channel(self, channel_name: str, message: str, dedup_seconds: float | None = None):
+		"""
+		Sends a message to a channel of the current group's guild, unless the same message
+		went to that channel within dedup_seconds (dedup.DEDUP_HOURS by default), even
+		before a restart. A message that fails to send isn't held back.
+		"""
 		channel = await self.get_channel_by_name(channel_name)
 		if not channel:
 			print(f"ERROR: invalid channel name {channel_name}")
 			return None
-		# prevent accidentally spamming channels with the same message
 		msg_key = f"{channel_name}: {message}"
-		if msg_key in self.recent_messages:
+		if self._quiet:
+			# nothing is recorded either, a quiet bot mustn't hold back the real one's messages
+			print(f"sending message -> {msg_key}")
+			return None
+		# prevent accidentally spamming channels with the same message
+		if not await self.run_blocking(self._claim_message, channel.id, message, dedup_seconds):
 			print(f"Not sending message to prevent spam | {msg_key}")
 			return None
-		self.recent_messages.append(msg_key)
 		print(f"sending message -> {msg_key}")
-		if self._quiet:
+		# the claim comes first so only one replica sends it, it's given back if the send fails
+		release = lambda: self.run_blocking(self._release_message, channel.id, message)
+		if self.outbox.buffer(channel, message, release):
+			# goes out with the rest of this window's messages for the channel
 			return None
-		else:
-			return await channel.send(message)
+		try:
+			return await self.outbox.send_message(channel, message)
+		except Exception:
+			await release()
+			raise
 
 	async def get_channel_by_name(self, name: str):
-		if not self._channels:
-			self._channels = {}
-			discord_channels = await self.guild.fetch_channels()
-			for d_c in discord_channels:
-				self._channels[d_c.name] = d_c
+		group = groups.current()
+		if not group.channels:
+			async with self._channels_lock:
+				if not group.channels:
+					with metrics.span('discord_fetch'):
+						discord_channels = await group.guild.fetch_channels()
+					group.channels = {d_c.name: d_c for d_c in discord_channels}
 		name = name.replace(" ", "-")
-		if name not in self._channels:
-			print(f"couldn't find {name} in channels {self._channels}")
+		if name not in group.channels:
+			print(f"couldn't find {name} in channels {group.channels}")
 			return None
 		else:
-			return self._channels[name]
+			return group.channels[name]
 	
 shared = Singleton()
\ No newline at end of file
@@ -0,0 +1,311 @@
+from shared import shared
+from aws import RallyBotModel
+from events import MeetupEvent, UpcomingIndex
+import metrics
+
+import os
+import copy
+import threading
+import datetime as dt
+from abc import ABC, abstractmethod
+from collections import Counter
+from traceback import format_exc as get_stacktrace
+from pynamodb.exceptions import AttributeDeserializationError, QueryError, UpdateError
+
+# which EventStore backs the bot, 'dynamodb' or 'memory'
+STORAGE = os.getenv('RALLY_STORAGE', 'dynamodb')
+
+def _now_ms() -> int:
+	return int(dt.datetime.now(shared.est).timestamp() * 1000)
+
+class EventStore(ABC):
+	"""
+	Where MeetupEvents (and the category cache) are kept. Reads return MeetupEvent instances
+	that know what they were loaded with, see MeetupEvent.changed_attributes.
+
+	put and delete may be buffered until flush, update always writes straight away.
+	`requests` counts round trips by kind.
+	"""
+	def __init__(self):
+		self.requests = Counter()
+
+	@property
+	def read_units(self) -> float:
+		# DynamoDB read capacity consumed so far by BatchGetItem and Scan calls
+		return 0.0
+
+	@abstractmethod
+	def get(self, sort: int) -> MeetupEvent | None:
+		raise NotImplementedError
+
+	@abstractmethod
+	def batch_get(self, sorts: list[int]) -> dict[int, MeetupEvent | None]:
+		"""
+		Loads many events at once.
+
+		Returns:
+			dict[int, MeetupEvent | None]: The events that exist keyed by sort. An event that
+			exists but can't be read is None.
+		"""
+		raise NotImplementedError
+
+	@abstractmethod
+	def query_upcoming(self, attributes: list[str] | None = None) -> list[MeetupEvent]:
+		# events loaded with a projection must not be written back
+		raise NotImplementedError
+
+	@abstractmethod
+	def by_snowflake(self, snowflake_id: int) -> MeetupEvent | None:
+		raise NotImplementedError
+
+	@abstractmethod
+	def snowflake_index(self, attributes: list[str] | None = None) -> dict[int, MeetupEvent]:
+		# every event with a discord event, keyed by snowflake id
+		raise NotImplementedError
+
+	@abstractmethod
+	def put(self, event: MeetupEvent):
+		raise NotImplementedError
+
+	@abstractmethod
+	def update(self, event: MeetupEvent):
+		# writes the attributes that changed since the event was loaded, or the whole event if it's new.
+		# raises MeetupEvent.DoesNotExist rather than recreating a stored event that was deleted since
+		raise NotImplementedError
+
+	@abstractmethod
+	def delete(self, event: MeetupEvent):
+		raise NotImplementedError
+
+	def flush(self):
+		pass
+
+	@abstractmethod
+	def get_categories(self, keys: list[int]) -> dict[int, str]:
+		raise NotImplementedError
+
+	@abstractmethod
+	def put_categories(self, categories: dict[int, str]):
+		raise NotImplementedError
+
+class DynamoDBStore(EventStore):
+	"""
+	EventStore on the RallyBot table. With write_behind, puts and deletes are held until
+	flush and then sent with BatchWriteItem, 25 items per request.
+	"""
+	def __init__(self, write_behind: bool = True):
+		super().__init__()
+		self.write_behind = write_behind
+		# sort -> (is_delete, event), a later write to the same event replaces the earlier one
+		self._pending: dict[int, tuple[bool, MeetupEvent]] = {}
+		self._lock = threading.Lock()
+
+	@property
+	def read_units(self) -> float:
+		return shared.ddb.read_units
+
+	def get(self, sort: int) -> MeetupEvent | None:
+		self.requests['get'] += 1
+		with metrics.span('ddb_read'):
+			try:
+				return MeetupEvent.get('event', sort)
+			except MeetupEvent.DoesNotExist:
+				return None
+
+	def batch_get(self, sorts: list[int]) -> dict[int, MeetupEvent | None]:
+		sorts = list(set(sorts))
+		self.requests['batch_get'] += (len(sorts) + 99) // 100
+		events = {}
+		with metrics.span('ddb_read'):
+			raw_items = shared.ddb.batch_get_raw([('event', sort) for sort in sorts])
+		for raw_item in raw_items:
+			sort = int(raw_item['sort']['N'])
+			try:
+				events[sort] = MeetupEvent.from_raw_data(raw_item)
+			except AttributeDeserializationError:
+				events[sort] = None
+		return events
+
+	def query_upcoming(self, attributes: list[str] | None = None) -> list[MeetupEvent]:
+		self.requests['query'] += 1
+		now = _now_ms()
+		try:
+			with metrics.span('ddb_read'):
+				return list(MeetupEvent.upcoming_index.query('event', MeetupEvent.timestamp > now, attributes_to_get=attributes))
+		except QueryError:
+			print(f"WARNING: couldn't query {UpcomingIndex.Meta.index_name}, falling back to scanning timestamp-index\n{get_stacktrace()}")
+			with metrics.span('ddb_read'):
+				return list(MeetupEvent.scan(index_name="timestamp-index", filter_condition=MeetupEvent.timestamp > now, attributes_to_get=attributes))
+
+	def by_snowflake(self, snowflake_id: int) -> MeetupEvent | None:
+		self.requests['query'] += 1
+		with metrics.span('ddb_read'):
+			return next(iter(MeetupEvent.snowflake_index.query(snowflake_id, limit=1)), None)
+
+	def snowflake_index(self, attributes: list[str] | None = None) -> dict[int, MeetupEvent]:
+		self.requests['scan'] += 1
+		index = {}
+		with metrics.span('ddb_read'):
+			raw_items = shared.ddb.scan_raw(index_name="snowflake_id-index", attributes=attributes)
+		for raw_item in raw_items:
+			try:
+				event = MeetupEvent.from_raw_data(raw_item)
+			except AttributeDeserializationError:
+				print(f"skipping unreadable event in snowflake index: {raw_item}")
+				continue
+			if event.snowflake_id:
+				index[int(event.snowflake_id)] = event
+		return index
+
+	def put(self, event: MeetupEvent):
+		if self.write_behind:
+			with self._lock:
+				self._pending[int(event.sort)] = (False, event)
+			return
+		self.requests['put'] += 1
+		# a full PutItem, MeetupEvent.save would only send what changed
+		with metrics.span('ddb_write'):
+			RallyBotModel.save(event)
+		event._mark_stored()
+
+	def update(self, event: MeetupEvent):
+		self.requests['update'] += 1
+		try:
+			with metrics.span('ddb_write'):
+				event.save()
+		except UpdateError as e:
+			if e.cause_response_code == 'ConditionalCheckFailedException':
+				raise MeetupEvent.DoesNotExist(f"event {event.sort} was deleted") from e
+			raise
+
+	def delete(self, event: MeetupEvent):
+		if self.write_behind:
+			with self._lock:
+				self._pending[int(event.sort)] = (True, event)
+			return
+		self.requests['delete'] += 1
+		with metrics.span('ddb_write'):
+			RallyBotModel.delete(event)
+
+	def flush(self):
+		with self._lock:
+			pending, self._pending = list(self._pending.values()), {}
+		if not pending:
+			return
+		self.requests['batch_write'] += (len(pending) + 24) // 25
+		with metrics.span('ddb_write'), MeetupEvent.batch_write() as batch:
+			for is_delete, event in pending:
+				if is_delete:
+					batch.delete(event)
+				else:
+					batch.save(event)
+		for is_delete, event in pending:
+			if not is_delete:
+				event._mark_stored()
+
+	def get_categories(self, keys: list[int]) -> dict[int, str]:
+		keys = list(set(keys))
+		self.requests['batch_get'] += (len(keys) + 99) // 100
+		with metrics.span('ddb_read'):
+			return {int(item.sort): item.data for item in RallyBotModel.batch_get([('category', key) for key in keys])}
+
+	def put_categories(self, categories: dict[int, str]):
+		self.requests['batch_write'] += (len(categories) + 24) // 25
+		with metrics.span('ddb_write'), RallyBotModel.batch_write() as batch:
+			for key, category in categories.items():
+				batch.save(RallyBotModel(id='category', sort=key, data=category))
+
+class MemoryStore(EventStore):
+	"""
+	EventStore kept in this process, for running without AWS. Events are stored serialized
+	so callers never share an instance with the store, the same as with a real database.
+	"""
+	def __init__(self):
+		super().__init__()
+		self._items: dict[int, dict] = {}
+		self._categories: dict[int, str] = {}
+		self._lock = threading.Lock()
+
+	def _load(self, data: dict, attributes: list[str] | None = None) -> MeetupEvent:
+		if attributes:
+			data = {name: value for name, value in data.items() if name in attributes}
+		return MeetupEvent.from_raw_data(copy.deepcopy(data))
+
+	def _matching(self, test) -> list[dict]:
+		with self._lock:
+			return [data for data in self._items.values() if test(data)]
+
+	def get(self, sort: int) -> MeetupEvent | None:
+		self.requests['get'] += 1
+		with self._lock:
+			data = self._items.get(int(sort))
+		return self._load(data) if data else None
+
+	def batch_get(self, sorts: list[int]) -> dict[int, MeetupEvent | None]:
+		sorts = set(map(int, sorts))
+		self.requests['batch_get'] += (len(sorts) + 99) // 100
+		return {int(data['sort']['N']): self._load(data) for data in self._matching(lambda data: int(data['sort']['N']) in sorts)}
+
+	def query_upcoming(self, attributes: list[str] | None = None) -> list[MeetupEvent]:
+		self.requests['query'] += 1
+		now = _now_ms()
+		return [self._load(data, attributes) for data in self._matching(lambda data: 'timestamp' in data and int(data['timestamp']['N']) > now)]
+
+	def by_snowflake(self, snowflake_id: int) -> MeetupEvent | None:
+		self.requests['query'] += 1
+		found = self._matching(lambda data: int(data.get('snowflake_id', {}).get('N', 0)) == int(snowflake_id))
+		return self._load(found[0]) if found else None
+
+	def snowflake_index(self, attributes: list[str] | None = None) -> dict[int, MeetupEvent]:
+		self.requests['scan'] += 1
+		index = {}
+		for data in self._matching(lambda data: int(data.get('snowflake_id', {}).get('N', 0))):
+			event = self._load(data, attributes)
+			index[int(event.snowflake_id)] = event
+		return index
+
+	def put(self, event: MeetupEvent):
+		self.requests['put'] += 1
+		with self._lock:
+			self._items[int(event.sort)] = event.serialize()
+		event._mark_stored()
+
+	def update(self, event: MeetupEvent):
+		if event._stored is None:
+			return self.put(event)
+		changed = event.changed_attributes()
+		if not changed:
+			return
+		self.requests['update'] += 1
+		current = event.serialize(null_check=False)
+		with self._lock:
+			data = self._items.get(int(event.sort))
+			if data is None:
+				# the same as the sort.exists() condition MeetupEvent.save adds
+				raise MeetupEvent.DoesNotExist(f"event {event.sort} was deleted")
+			for name in changed:
+				attr_name = event.get_attributes()[name].attr_name
+				if attr_name in current:
+					data[attr_name] = current[attr_name]
+				else:
+					data.pop(attr_name, None)
+		event._mark_stored()
+
+	def delete(self, event: MeetupEvent):
+		self.requests['delete'] += 1
+		with self._lock:
+			self._items.pop(int(event.sort), None)
+
+	def get_categories(self, keys: list[int]) -> dict[int, str]:
+		self.requests['batch_get'] += 1
+		return {key: self._categories[key] for key in keys if key in self._categories}
+
+	def put_categories(self, categories: dict[int, str]):
+		self.requests['batch_write'] += 1
+		self._categories.update(categories)
+
+def create_store() -> EventStore:
+	if STORAGE == 'memory':
+		print("ALERT: keeping events in memory, nothing will be saved to dynamodb")
+		return MemoryStore()
+	return DynamoDBStore()
@@ -0,0 +1,109 @@
+import time
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+import net
+
+class HostLimiterTest(unittest.TestCase):
+	def limiter(self, max_limit: int = 2) -> net.HostLimiter:
+		return net.HostLimiter('example.com', max_limit)
+
+	def open_circuit(self, limiter: net.HostLimiter):
+		for _ in range(net.BREAKER_FAILURES):
+			limiter.release(False, limiter.acquire())
+		self.assertIsNotNone(limiter.opened_at)
+
+	def test_limit_halves_on_failure_and_grows_back(self):
+		limiter = self.limiter(4)
+		limiter.release(False, limiter.acquire())
+		self.assertEqual(limiter.limit, 2.0)
+		for _ in range(10):
+			limiter.release(True, limiter.acquire())
+		self.assertEqual(limiter.limit, 4.0)
+		self.assertEqual(limiter.in_flight, 0)
+
+	def test_acquire_waits_for_a_free_slot(self):
+		limiter = self.limiter(1)
+		limiter.acquire()
+		acquired = threading.Event()
+		def other():
+			limiter.acquire()
+			acquired.set()
+		threading.Thread(target=other, daemon=True).start()
+		self.assertFalse(acquired.wait(0.05))
+		limiter.release(True)
+		self.assertTrue(acquired.wait(1))
+
+	def test_circuit_opens_after_repeated_failures(self):
+		limiter = self.limiter()
+		self.open_circuit(limiter)
+		with self.assertRaises(net.CircuitOpenError):
+			limiter.acquire()
+
+	def test_single_trial_after_the_wait(self):
+		limiter = self.limiter()
+		self.open_circuit(limiter)
+		limiter.opened_at -= net.BREAKER_SECONDS
+		self.assertTrue(limiter.acquire())
+		with self.assertRaises(net.CircuitOpenError):
+			limiter.acquire()
+		limiter.release(True, True)
+		self.assertIsNone(limiter.opened_at)
+		self.assertFalse(limiter.acquire())
+
+	def test_failed_trial_opens_the_circuit_again(self):
+		limiter = self.limiter()
+		self.open_circuit(limiter)
+		limiter.opened_at -= net.BREAKER_SECONDS
+		limiter.release(False, limiter.acquire())
+		self.assertGreater(limiter.opened_at, time.monotonic() - 1)
+		with self.assertRaises(net.CircuitOpenError):
+			limiter.acquire()
+
+	@mock.patch.object(net, 'BREAKER_FAILURES', 2)
+	def test_leftover_call_does_not_end_the_trial(self):
+		# the limit has to stay above one for a trial to start next to a leftover call
+		limiter = self.limiter(8)
+		calls = [limiter.acquire() for _ in range(3)]
+		for trial in calls[:2]:
+			limiter.release(False, trial)
+		leftover = calls[2]
+		self.assertIsNotNone(limiter.opened_at)
+		limiter.opened_at -= net.BREAKER_SECONDS
+		trial = limiter.acquire()
+		# a call from before the circuit opened finishes while the trial is running
+		limiter.release(True, leftover)
+		self.assertIsNotNone(limiter.opened_at)
+		with self.assertRaises(net.CircuitOpenError):
+			limiter.acquire()
+		limiter.release(True, trial)
+		self.assertIsNone(limiter.opened_at)
+		self.assertEqual(limiter.in_flight, 0)
+
+class HttpClientTest(unittest.TestCase):
+	def client(self) -> net.HttpClient:
+		with mock.patch.object(net, 'HTTP_CACHE_MB', 0):
+			return net.HttpClient(per_host_limit=2)
+
+	def test_slot_released_on_any_exception(self):
+		client = self.client()
+		with mock.patch.object(client.session, 'request', side_effect=requests.exceptions.ChunkedEncodingError()):
+			for _ in range(3):
+				with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+					client.get('https://example.com/')
+		limiter = client._limiter('example.com')
+		self.assertEqual(limiter.in_flight, 0)
+		self.assertEqual(limiter.failures, 3)
+
+	def test_slot_released_after_retries(self):
+		client = self.client()
+		with mock.patch.object(client.session, 'request', side_effect=requests.ConnectionError()), mock.patch.object(net, 'BACKOFF', 0):
+			with self.assertRaises(requests.ConnectionError):
+				client.get('https://example.com/')
+		self.assertEqual(client._limiter('example.com').in_flight, 0)
+
+if __name__ == '__main__':
+	unittest.main()